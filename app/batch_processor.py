@@ -1,71 +1,159 @@
 import os
-import json
+import sys
+import orjson
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from typing import List, Dict, Any, Optional
 from dotenv import load_dotenv
-from app.pdf_processor import PDFProcessor
+from app.pdf_processor import PDFProcessor, document_key, vector_id_prefix
 from app.pinecone_setup import PineconeManager
 
 # Load environment variables
 load_dotenv()
 
 class BatchProcessor:
-    def __init__(self):
+    def __init__(self, catalog_file: str = "document_catalog.json", max_docs_in_flight: int = 4):
         self.pdf_processor = PDFProcessor()
         self.pinecone_manager = PineconeManager()
         # Using Pinecone only
+        self.catalog_file = catalog_file
+        # Append-only log of entries added since the last full catalog write
+        self.journal_file = os.path.splitext(catalog_file)[0] + ".jsonl"
+        self._dirty = False
+        self._flush_every = 50
+        # Documents are processed on worker threads; catalog updates and saves go through this lock
+        self._catalog_lock = threading.RLock()
+        self.max_docs_in_flight = max_docs_in_flight
+        self.document_catalog = self.load_catalog()
         
     def load_catalog(self) -> Dict[str, Any]:
         try:
             if os.path.exists(self.catalog_file):
-                with open(self.catalog_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
+                with open(self.catalog_file, 'rb') as f:
+                    catalog = orjson.loads(f.read())
             else:
-                return {"documents": [], "last_updated": None, "total_processed": 0}
+                catalog = {"documents": [], "last_updated": None, "total_processed": 0}
         except Exception as e:
             print(f"Error loading catalog: {e}")
-            return {"documents": [], "last_updated": None, "total_processed": 0}
+            catalog = {"documents": [], "last_updated": None, "total_processed": 0}
+        
+        # Replay entries that were journaled but not yet compacted into the catalog
+        try:
+            if os.path.exists(self.journal_file):
+                with open(self.journal_file, 'rb') as f:
+                    for line in f:
+                        if not line.strip():
+                            continue
+                        doc_entry = orjson.loads(line)
+                        catalog["documents"].append(doc_entry)
+                        if doc_entry["success"]:
+                            catalog["total_processed"] += 1
+                        self._dirty = True
+        except Exception as e:
+            print(f"Error replaying catalog journal: {e}")
+        
+        self._build_url_index(catalog["documents"])
+        return catalog
+    
+    def _build_url_index(self, documents: List[Dict[str, Any]]):
+        # URL -> position in documents; later entries win for reprocessed URLs
+        self._url_index = {}
+        for i, doc in enumerate(documents):
+            self._url_index[doc["url"]] = i
+        # Running totals over the latest entry per URL, so get_catalog_summary never has to walk
+        # the catalog; superseded versions' vectors are collected, so they are not counted
+        self._running = {"successful": 0, "total_chunks": 0}
+        for position in self._url_index.values():
+            self._count(documents[position], 1)
+    
+    def _count(self, doc: Dict[str, Any], sign: int):
+        if doc["success"]:
+            self._running["successful"] += sign
+            self._running["total_chunks"] += sign * doc["chunks_count"]
     
     def save_catalog(self):
+        """Write the full catalog and truncate the journal it supersedes"""
+        with self._catalog_lock:
+            try:
+                self.document_catalog["last_updated"] = datetime.now().isoformat()
+                # Write a temp file and swap it in, so a crash mid-write leaves the old catalog intact;
+                # the journal is only removed once the new catalog is in place
+                tmp_file = self.catalog_file + ".tmp"
+                with open(tmp_file, 'wb') as f:
+                    f.write(orjson.dumps(self.document_catalog, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_file, self.catalog_file)
+                if os.path.exists(self.journal_file):
+                    os.remove(self.journal_file)
+                self._dirty = False
+                print(f"Catalog updated: {self.catalog_file}")
+            except Exception as e:
+                print(f"Error saving catalog: {e}")
+    
+    def _append_to_journal(self, doc_entry: Dict[str, Any]):
+        line = orjson.dumps(doc_entry, option=orjson.OPT_APPEND_NEWLINE)
+        fd = os.open(self.journal_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
         try:
-            self.document_catalog["last_updated"] = datetime.now().isoformat()
-            with open(self.catalog_file, 'w', encoding='utf-8') as f:
-                json.dump(self.document_catalog, f, indent=2, ensure_ascii=False)
-            print(f"Catalog updated: {self.catalog_file}")
-        except Exception as e:
-            print(f"Error saving catalog: {e}")
+            os.write(fd, line)
+        finally:
+            os.close(fd)
     
     def is_document_processed(self, url: str) -> bool:
-        for doc in self.document_catalog["documents"]:
-            if doc["url"] == url:
-                return True
-        return False
-    
-    def add_to_catalog(self, url: str, title: str, chunks_count: int, success: bool):
-        doc_entry = {
-            "url": url,
-            "title": title,
-            "processed_at": datetime.now().isoformat(),
-            "chunks_count": chunks_count,
-            "success": success,
-            "document_id": f"doc_{len(self.document_catalog['documents']) + 1}"
-        }
-        
-        self.document_catalog["documents"].append(doc_entry)
-        if success:
-            self.document_catalog["total_processed"] += 1
-        self.save_catalog()
+        # Only a successful latest attempt counts; failed and partial runs are retried
+        if url not in self._url_index:
+            return False
+        return self.document_catalog["documents"][self._url_index[url]]["success"]
+    
+    def next_version(self, url: str) -> int:
+        """Version to use when (re)processing a URL; vectors from older versions become stale"""
+        if url not in self._url_index:
+            return 1
+        previous = self.document_catalog["documents"][self._url_index[url]]
+        return previous.get("doc_version", 1) + 1
+    
+    def add_to_catalog(self, url: str, title: str, chunks_count: int, success: bool, doc_version: int = 1):
+        with self._catalog_lock:
+            documents = self.document_catalog["documents"]
+            doc_entry = {
+                "url": url,
+                "title": title,
+                "processed_at": datetime.now().isoformat(),
+                "chunks_count": chunks_count,
+                "success": success,
+                "document_id": f"doc_{len(documents) + 1}",
+                "doc_version": doc_version
+            }
+            
+            # The new entry replaces the URL's previous one in the running totals
+            if url in self._url_index:
+                self._count(documents[self._url_index[url]], -1)
+            self._url_index[url] = len(documents)
+            documents.append(doc_entry)
+            self._count(doc_entry, 1)
+            if success:
+                self.document_catalog["total_processed"] += 1
+            self._dirty = True
+            
+            # Journal every entry, but only rewrite the full catalog periodically
+            try:
+                self._append_to_journal(doc_entry)
+            except Exception as e:
+                print(f"Error writing catalog journal: {e}")
+            if len(documents) % self._flush_every == 0:
+                self.save_catalog()
     
     def get_catalog_summary(self) -> Dict[str, Any]:
-        total_docs = len(self.document_catalog["documents"])
-        successful_docs = sum(1 for doc in self.document_catalog["documents"] if doc["success"])
-        total_chunks = sum(doc["chunks_count"] for doc in self.document_catalog["documents"] if doc["success"])
+        # One document per URL; earlier entries for a reprocessed URL are history, not content
+        total_docs = len(self._url_index)
+        successful_docs = self._running["successful"]
         
         return {
             "total_documents": total_docs,
             "successful_documents": successful_docs,
             "failed_documents": total_docs - successful_docs,
-            "total_chunks": total_chunks,
+            "total_chunks": self._running["total_chunks"],
             "last_updated": self.document_catalog.get("last_updated")
         }
     
@@ -81,60 +169,86 @@ class BatchProcessor:
         print(f"BATCH PROCESSING: {len(documents)} documents")
         print(f"{'='*80}")
         
-        for i, doc in enumerate(documents, 1):
-            url = doc["url"]
-            title = doc.get("title", f"Document {i}")
-            
-            print(f"\n[{i}/{len(documents)}] Processing: {title}")
-            print(f"URL: {url}")
-            
-            # Check if already processed
-            if not force_reprocess and self.is_document_processed(url):
-                print(f"Skipping - already processed: {title}")
-                results["skipped"] += 1
-                results["details"].append({
-                    "title": title,
-                    "url": url,
-                    "status": "skipped",
-                    "reason": "already_processed"
-                })
-                continue
-            
-            # Process the document
-            try:
-                success, chunks_count = self.pdf_processor.process_pdf_url(url, title)
-                
-                if success:
-                    print(f"Successfully processed: {title} ({chunks_count} chunks)")
-                    results["processed"] += 1
-                    results["details"].append({
-                        "title": title,
-                        "url": url,
-                        "status": "success",
-                        "chunks_count": chunks_count
-                    })
-                    self.add_to_catalog(url, title, chunks_count, True)
-                else:
-                    print(f"Failed to process: {title}")
-                    results["failed"] += 1
-                    results["details"].append({
-                        "title": title,
-                        "url": url,
-                        "status": "failed",
-                        "reason": "processing_error"
-                    })
-                    self.add_to_catalog(url, title, 0, False)
+        # Documents are independent, so overlap their download/embed/upload stages. Workers share
+        # one PDFProcessor: its index connection is opened once and its embedding client is thread-safe
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_docs_in_flight) as pool:
+                futures = {}
+                queued = set()
+                for i, doc in enumerate(documents, 1):
+                    url = doc["url"]
+                    title = doc.get("title", f"Document {i}")
                     
-            except Exception as e:
-                print(f"Error processing {title}: {e}")
-                results["failed"] += 1
-                results["details"].append({
-                    "title": title,
-                    "url": url,
-                    "status": "failed",
-                    "reason": str(e)
-                })
-                self.add_to_catalog(url, title, 0, False)
+                    print(f"\n[{i}/{len(documents)}] Queueing: {title}")
+                    print(f"URL: {url}")
+                    
+                    # Check if already processed (or already queued in this batch)
+                    if url in queued or (not force_reprocess and self.is_document_processed(url)):
+                        print(f"Skipping - already processed: {title}")
+                        results["skipped"] += 1
+                        results["details"].append({
+                            "title": title,
+                            "url": url,
+                            "status": "skipped",
+                            "reason": "already_processed"
+                        })
+                        continue
+                    
+                    version = self.next_version(url)
+                    queued.add(url)
+                    future = pool.submit(self.pdf_processor.process_pdf_url, url, title, version)
+                    futures[future] = (url, title, version)
+                
+                for future in as_completed(futures):
+                    url, title, version = futures[future]
+                    try:
+                        success, chunks_count = future.result()
+                        
+                        if success:
+                            print(f"Successfully processed: {title} ({chunks_count} chunks)")
+                            results["processed"] += 1
+                            results["details"].append({
+                                "title": title,
+                                "url": url,
+                                "status": "success",
+                                "chunks_count": chunks_count,
+                                "doc_version": version
+                            })
+                            self.add_to_catalog(url, title, chunks_count, True, version)
+                        else:
+                            print(f"Failed to process: {title}")
+                            results["failed"] += 1
+                            results["details"].append({
+                                "title": title,
+                                "url": url,
+                                "status": "failed",
+                                "reason": "processing_error"
+                            })
+                            self.add_to_catalog(url, title, 0, False, version)
+                            
+                    except Exception as e:
+                        print(f"Error processing {title}: {e}")
+                        results["failed"] += 1
+                        results["details"].append({
+                            "title": title,
+                            "url": url,
+                            "status": "failed",
+                            "reason": str(e)
+                        })
+                        self.add_to_catalog(url, title, 0, False, version)
+        finally:
+            # Flush whatever the periodic saves have not written yet
+            if self._dirty:
+                self.save_catalog()
+        
+        # A successful reprocess supersedes the previous version's vectors, which would
+        # otherwise come back as duplicates in retrieval
+        reprocessed = [
+            detail["url"] for detail in results["details"]
+            if detail["status"] == "success" and detail["doc_version"] > 1
+        ]
+        if reprocessed:
+            self.collect_stale_vectors(reprocessed)
         
         print(f"\n{'='*80}")
         print(f"BATCH PROCESSING COMPLETE")
@@ -163,15 +277,38 @@ class BatchProcessor:
             print("Pinecone index is empty - no knowledge base content found")
             return False
     
+    def _delete_stale_versions(self, url: str) -> int:
+        """Delete a URL's vectors from versions older than its latest successful one"""
+        doc = self.document_catalog["documents"][self._url_index[url]]
+        if not doc["success"]:
+            # Keep the previous version's vectors until a reprocess succeeds
+            return 0
+        keep_prefix = vector_id_prefix(url, doc.get("doc_version", 1))
+        return self.pinecone_manager.delete_by_prefix(document_key(url) + "#", keep_prefix)
+    
+    def collect_stale_vectors(self, urls: Optional[List[str]] = None) -> int:
+        """Delete vectors left behind by older versions of catalogued documents; safe to run on a schedule"""
+        if not self.pinecone_manager.connect_to_index():
+            print("Failed to connect to Pinecone index")
+            return 0
+        
+        # The latest entry per URL decides which version is current
+        deleted = sum(self._delete_stale_versions(url) for url in (urls or list(self._url_index)))
+        
+        print(f"Deleted {deleted} stale vectors")
+        return deleted
+    
     def get_processed_documents(self) -> List[Dict[str, Any]]:
         return [doc for doc in self.document_catalog["documents"] if doc["success"]]
     
     def remove_document_from_catalog(self, url: str):
-        self.document_catalog["documents"] = [
-            doc for doc in self.document_catalog["documents"] 
-            if doc["url"] != url
-        ]
-        self.save_catalog()
+        with self._catalog_lock:
+            self.document_catalog["documents"] = [
+                doc for doc in self.document_catalog["documents"] 
+                if doc["url"] != url
+            ]
+            self._build_url_index(self.document_catalog["documents"])
+            self.save_catalog()
         print(f"Removed document from catalog: {url}")
 
 def create_default_knowledge_base():
@@ -190,6 +327,11 @@ def create_default_knowledge_base():
 def main():
     processor = BatchProcessor()
     
+    # "gc" removes vectors from superseded document versions, e.g. from a nightly job
+    if sys.argv[1:2] == ["gc"]:
+        processor.collect_stale_vectors()
+        return
+    
     # Example: Process multiple documents
     documents_to_process = [
         {
@@ -0,0 +1,129 @@
+"""
+Embedding backends for AI Advisor
+OpenAI for incremental updates, or a local Text Embeddings Inference (TEI) server for bulk ingest
+"""
+
+import os
+import asyncio
+import threading
+from typing import List, Optional, Protocol
+import openai
+from dotenv import load_dotenv
+from tenacity import wait_exponential_jitter
+
+load_dotenv()
+
+try:
+    import httpx
+    HTTPX_AVAILABLE = True
+except ImportError:
+    HTTPX_AVAILABLE = False
+
+# Transient failures worth retrying; clients' own retries are off, so these are retried by callers.
+# APITimeoutError is an APIConnectionError
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+def is_retryable(error: BaseException) -> bool:
+    """Whether an embedding request failed transiently; auth errors, bad inputs and 413s are not retried"""
+    if isinstance(error, RETRYABLE_ERRORS):
+        return True
+    if HTTPX_AVAILABLE:
+        if isinstance(error, httpx.HTTPStatusError):
+            return error.response.status_code in RETRYABLE_STATUSES
+        return isinstance(error, httpx.TransportError)
+    return False
+
+def _retry_after(error: BaseException) -> Optional[float]:
+    """Seconds the server asked us to wait, or None if it did not say"""
+    response = getattr(error, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+_backoff = wait_exponential_jitter(initial=1, max=30)
+
+def wait_retry_after(retry_state) -> float:
+    """Wait as long as Retry-After asks, else back off exponentially with jitter"""
+    return _retry_after(retry_state.outcome.exception()) or _backoff(retry_state)
+
+class EmbeddingBackend(Protocol):
+    model: str
+    dimension: int
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]: ...
+
+    def embed_query(self, text: str) -> List[float]: ...
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]: ...
+
+class OpenAIBackend:
+    """OpenAI embeddings through langchain_openai"""
+
+    def __init__(self, model: str = "text-embedding-3-large", dimension: int = 3072, batch_size: int = 256):
+        # Imported here so modules that only pick a backend stay light to import
+        from langchain_openai import OpenAIEmbeddings
+        
+        self.model = model
+        self.dimension = dimension
+        # Callers retry transient errors themselves, so the client does not retry underneath them
+        self.embeddings = OpenAIEmbeddings(model=model, chunk_size=batch_size, max_retries=0)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embeddings.embed_query(text)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        # OpenAIEmbeddings' async client binds to the first event loop that uses it, and each
+        # document runs its own loop, so go through the sync client on a worker thread instead
+        return await asyncio.to_thread(self.embed_documents, texts)
+
+class TEIBackend:
+    """Embeddings from a text-embeddings-inference server's /embed endpoint"""
+
+    def __init__(self, url: str = None, model: str = None, dimension: int = None,
+                 max_batch_size: int = None, max_concurrency: int = None):
+        if not HTTPX_AVAILABLE:
+            raise ImportError("httpx not available. Please install: pip install httpx")
+
+        self.url = (url or os.getenv("TEI_URL", "http://localhost:8080")).rstrip("/")
+        # Used to key cached vectors, so it must name the model the server is running
+        self.model = model or os.getenv("TEI_MODEL", "BAAI/bge-large-en-v1.5")
+        self.dimension = dimension or int(os.getenv("TEI_DIMENSION", "1024"))
+        # TEI rejects requests larger than its --max-client-batch-size (32 by default)
+        self.max_batch_size = max_batch_size or int(os.getenv("TEI_MAX_BATCH_SIZE", "32"))
+        # Roughly one in-flight request per GPU keeps the server saturated without queueing
+        self._slots = threading.BoundedSemaphore(max_concurrency or int(os.getenv("TEI_MAX_CONCURRENCY", "1")))
+        self.client = httpx.Client(base_url=self.url, timeout=60)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = []
+        for start in range(0, len(texts), self.max_batch_size):
+            with self._slots:
+                response = self.client.post(
+                    "/embed",
+                    json={"inputs": texts[start:start + self.max_batch_size], "truncate": True}
+                )
+            response.raise_for_status()
+            vectors.extend(response.json())
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        # The sync client is shared across threads and event loops; an AsyncClient would be tied to one loop
+        return await asyncio.to_thread(self.embed_documents, texts)
+
+def get_embedding_backend(batch_size: int = 256) -> EmbeddingBackend:
+    """Backend selected by EMBEDDING_BACKEND ("openai" or "tei"); ingest and queries must use the same one"""
+    name = os.getenv("EMBEDDING_BACKEND", "openai").lower()
+    if name == "tei":
+        return TEIBackend()
+    if name == "openai":
+        return OpenAIBackend(batch_size=batch_size)
+    raise ValueError(f"Unknown EMBEDDING_BACKEND '{name}'. Use 'openai' or 'tei'.")
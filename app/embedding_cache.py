@@ -0,0 +1,53 @@
+"""
+Embedding cache for AI Advisor
+Stores embedding vectors in SQLite keyed by a hash of (model, text)
+"""
+
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+from typing import List, Optional, Sequence
+
+# Stay well below SQLite's limit on bound parameters per statement
+_MAX_LOOKUP_PARAMS = 500
+
+class EmbeddingCache:
+
+    def __init__(self, model: str, path: str = "embed_cache.db"):
+        self.model = model
+        self.path = path
+        # Shared by documents processed on different threads
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute("CREATE TABLE IF NOT EXISTS cache (hash BLOB PRIMARY KEY, vec BLOB)")
+        self.conn.commit()
+
+    def key(self, text: str) -> bytes:
+        """Content hash of a text, scoped to the embedding model"""
+        return hashlib.blake2b(f"{self.model}\x00{text}".encode("utf-8"), digest_size=16).digest()
+
+    def get_many(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """Return the cached float32 vector for each text, or None where it is not cached"""
+        keys = [self.key(text) for text in texts]
+        found = {}
+        with self.lock:
+            for start in range(0, len(keys), _MAX_LOOKUP_PARAMS):
+                batch = keys[start:start + _MAX_LOOKUP_PARAMS]
+                placeholders = ",".join("?" * len(batch))
+                rows = self.conn.execute(
+                    f"SELECT hash, vec FROM cache WHERE hash IN ({placeholders})", batch
+                ).fetchall()
+                for h, vec in rows:
+                    found[h] = np.frombuffer(vec, dtype=np.float32)
+        return [found.get(k) for k in keys]
+
+    def set_many(self, texts: List[str], vectors: Sequence[Sequence[float]]):
+        """Store vectors for texts; existing entries are left untouched"""
+        rows = [(self.key(text), np.asarray(vector, dtype=np.float32).tobytes()) for text, vector in zip(texts, vectors)]
+        with self.lock:
+            self.conn.executemany("INSERT OR IGNORE INTO cache (hash, vec) VALUES (?, ?)", rows)
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
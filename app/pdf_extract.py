@@ -0,0 +1,37 @@
+"""
+PDF text extraction for AI Advisor
+Runs in the extraction worker processes, so it imports only PyMuPDF and shared memory
+"""
+
+from multiprocessing import shared_memory
+from typing import List, Tuple, Optional, Union
+import pymupdf
+
+def open_pdf(source: Union[str, bytes]):
+    """Open a PDF from a path or in-memory bytes with the MuPDF C backend"""
+    if isinstance(source, (bytes, bytearray)):
+        return pymupdf.open(stream=source, filetype="pdf")
+    return pymupdf.open(source)
+
+def page_text(page) -> str:
+    return page.get_text("text")
+
+def extract_page_range(source: Union[str, Tuple[str, int]], start: int, stop: int) -> List[Tuple[int, Optional[str], Optional[str]]]:
+    """Extract pages [start, stop) in a worker process, returning (page_num, text, error) per page"""
+    if isinstance(source, tuple):
+        # In-memory PDFs arrive as a shared memory block, so each task does not pickle the whole file
+        name, size = source
+        shm = shared_memory.SharedMemory(name=name)
+        try:
+            source = bytes(shm.buf[:size])
+        finally:
+            shm.close()
+    
+    results = []
+    with open_pdf(source) as pdf:
+        for page_num in range(start, stop):
+            try:
+                results.append((page_num, page_text(pdf[page_num]), None))
+            except Exception as e:
+                results.append((page_num, None, str(e)))
+    return results
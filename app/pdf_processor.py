@@ -1,161 +1,376 @@
 import os
+import io
+import asyncio
+import hashlib
+import itertools
+import multiprocessing
+import re
+import threading
 import requests
-import pdfplumber
-import uuid
+import tiktoken
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from dataclasses import dataclass
+from collections import deque
 from datetime import datetime
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple, Optional, Union, Iterable, Iterator
 from dotenv import load_dotenv
-from langchain_openai import OpenAIEmbeddings
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt
 from app.pinecone_setup import PineconeManager
+from app.pdf_extract import open_pdf, extract_page_range
+from app.embedding_cache import EmbeddingCache
+from app.embedding_backends import get_embedding_backend, is_retryable, wait_retry_after
 
 load_dotenv()
 
+EMBEDDING_MAX_RETRIES = 5
+# Pages handed to each extraction worker per task, to amortize opening the PDF
+PAGES_PER_TASK = 16
+
+# Catalog section headings: numbered ("3.10 Admission Requirements") or all-caps lines
+_HEADING_RE = re.compile(r"^(?:\d+\.\d+\s+[A-Z].*|[A-Z ]{6,})$")
+_ENC = tiktoken.encoding_for_model("text-embedding-3-large")
+
+def _starts_char(token_id: int) -> bool:
+    """Whether a token begins on a UTF-8 character boundary rather than partway through one"""
+    return _ENC.decode_single_token_bytes(token_id)[0] & 0xC0 != 0x80
+
+def _token_windows(text: str, size: int, overlap: int) -> Iterator[Tuple[str, int]]:
+    """Split text into overlapping windows of at most size tokens, yielding (text, token count)"""
+    # Encode once and slice token ids, rather than re-tokenizing every candidate split
+    ids = _ENC.encode(text)
+    n = len(ids)
+    start = 0
+    while True:
+        # Cut only where a character starts, so no slice decodes a split multibyte character to U+FFFD
+        end = min(start + size, n)
+        while start + 1 < end < n and not _starts_char(ids[end]):
+            end -= 1
+        yield _ENC.decode(ids[start:end]).strip(), end - start
+        # Stop once a window reaches the end, rather than emit one that only repeats its overlap
+        if end >= n:
+            break
+        start = max(end - overlap, start + 1)
+        while start < end and not _starts_char(ids[start]):
+            start += 1
+
+@dataclass
+class IndexingConfig:
+    batch_size: int = 256              # Chunks sent to the embeddings endpoint per request
+    max_concurrent_batches: int = 4    # Embedding requests in flight at once
+    max_queue_size: int = 8            # Batches buffered between pipeline stages
+    vector_dtype: str = "float16"      # Precision vectors are held at until upload
+    chunk_tokens: int = 600            # Target chunk length in embedding-model tokens
+    chunk_overlap_tokens: int = 100    # Tokens shared between neighbouring chunks
+    min_chunk_tokens: int = 40         # Shorter chunks are boilerplate and are dropped
+    extract_workers: int = 0           # Text extraction processes shared by all documents; 0 means one per core
+
+def document_key(url: str) -> str:
+    """Stable identifier for a source document, used as the prefix of its vector IDs"""
+    return hashlib.blake2b(url.encode("utf-8"), digest_size=12).hexdigest()
+
+def vector_id_prefix(url: str, version: int) -> str:
+    return f"{document_key(url)}#v{version}#"
+
+def vector_id(url: str, version: int, chunk_index: int) -> str:
+    """Deterministic vector ID, so re-uploading the same chunk overwrites instead of duplicating"""
+    return f"{vector_id_prefix(url, version)}{chunk_index}"
+
 class PDFProcessor:
-    def __init__(self):
-        self.embeddings = OpenAIEmbeddings(model="text-embedding-3-large")
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=200,
-            length_function=len,
-        )
+    def __init__(self, config: IndexingConfig = None):
+        self.config = config or IndexingConfig()
+        # OpenAI by default; EMBEDDING_BACKEND=tei targets a local TEI server for bulk ingest
+        self.embeddings = get_embedding_backend(batch_size=self.config.batch_size)
+        self.embed_cache = EmbeddingCache(model=self.embeddings.model)
         self.pinecone_manager = PineconeManager()
+        self._connect_lock = threading.Lock()
+        # Reused across downloads so connections stay alive between PDFs
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=8,
+            pool_maxsize=16,
+            max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504))
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # One extraction pool for every document, created on first use
+        self.extract_workers = self.config.extract_workers or os.cpu_count() or 1
+        self._extract_pool = None
+        self._extract_pool_lock = threading.Lock()
         
-    def download_pdf(self, url: str, temp_filename: str = "temp_document.pdf") -> str:
+    def download_pdf(self, url: str) -> Optional[io.BytesIO]:
         try:
             print(f"Downloading PDF from: {url}")
-            response = requests.get(url, stream=True)
+            response = self.session.get(url, stream=True, timeout=30)
             response.raise_for_status()
             
-            with open(temp_filename, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
+            buffer = io.BytesIO()
+            for chunk in response.iter_content(chunk_size=65536):
+                buffer.write(chunk)
+            buffer.seek(0)
             
-            print(f"PDF downloaded successfully: {temp_filename}")
-            return temp_filename
+            print(f"PDF downloaded successfully: {buffer.getbuffer().nbytes} bytes")
+            return buffer
             
         except Exception as e:
             print(f"Error downloading PDF: {e}")
             return None
     
-    def extract_text_from_pdf(self, pdf_path: str) -> List[str]:
-        try:
-            print(f"Extracting text from: {pdf_path}")
-            text_content = []
-            
-            with pdfplumber.open(pdf_path) as pdf:
-                for page_num, page in enumerate(pdf.pages):
-                    try:
-                        text = page.extract_text()
-                        if text and text.strip():
-                            text_content.append(text.strip())
-                            print(f"Extracted text from page {page_num + 1}")
-                    except Exception as e:
-                        print(f"Error extracting page {page_num + 1}: {e}")
-                        continue
-            
-            print(f"Successfully extracted text from {len(text_content)} pages")
-            return text_content
-            
-        except Exception as e:
-            print(f"Error opening PDF: {e}")
-            return []
+    def _get_extract_pool(self) -> ProcessPoolExecutor:
+        """Shared, bounded pool of extraction processes"""
+        with self._extract_pool_lock:
+            if self._extract_pool is None:
+                # Documents are processed on threads by now, and forking a threaded process can
+                # deadlock on locks held at fork time, so workers come from a forkserver instead.
+                # The server preloads the extraction module, so workers fork with PyMuPDF already loaded
+                context = multiprocessing.get_context("forkserver")
+                context.set_forkserver_preload(["app.pdf_extract"])
+                self._extract_pool = ProcessPoolExecutor(
+                    max_workers=self.extract_workers,
+                    mp_context=context
+                )
+            return self._extract_pool
     
-    def chunk_text(self, texts: List[str]) -> List[str]:
+    def iter_page_texts(self, pdf_source: Union[str, io.BytesIO]) -> Iterator[str]:
+        """Yield the text of each non-empty page in document order"""
+        shm = None
+        if isinstance(pdf_source, io.BytesIO):
+            print("Extracting text from downloaded PDF")
+            with pdf_source.getbuffer() as data:
+                with open_pdf(bytes(data)) as pdf:
+                    n_pages = len(pdf)
+                shm = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+                shm.buf[:data.nbytes] = data
+                source = (shm.name, data.nbytes)
+        else:
+            print(f"Extracting text from: {pdf_source}")
+            source = pdf_source
+            with open_pdf(source) as pdf:
+                n_pages = len(pdf)
+        
+        # Pages are independent, so fan page ranges out across cores
+        page_ranges = deque(
+            (start, min(start + PAGES_PER_TASK, n_pages))
+            for start in range(0, n_pages, PAGES_PER_TASK)
+        )
+        pool = self._get_extract_pool()
+        extracted = 0
+        futures = deque()
         try:
-            print("Chunking text for optimal embedding...")
-            all_chunks = []
-            
-            for text in texts:
-                chunks = self.text_splitter.split_text(text)
-                all_chunks.extend(chunks)
-            
-            print(f"Created {len(all_chunks)} text chunks")
-            return all_chunks
-            
-        except Exception as e:
-            print(f"Error chunking text: {e}")
-            return []
+            # Keep only a couple of ranges per worker ahead of the consumer
+            while page_ranges or futures:
+                while page_ranges and len(futures) < 2 * self.extract_workers:
+                    futures.append(pool.submit(extract_page_range, source, *page_ranges.popleft()))
+                # Collect in submission order so pages stay in document order
+                for page_num, text, error in futures.popleft().result():
+                    if error:
+                        print(f"Error extracting page {page_num + 1}: {error}")
+                    elif text and text.strip():
+                        extracted += 1
+                        yield text.strip()
+        except BrokenProcessPool:
+            # A crashed worker breaks the whole pool, so start a fresh one for the next document
+            with self._extract_pool_lock:
+                if self._extract_pool is pool:
+                    self._extract_pool = None
+            raise
+        finally:
+            for future in futures:
+                future.cancel()
+            if shm is not None:
+                # Let running tasks finish reading the block before it is freed
+                for future in futures:
+                    if not future.cancelled():
+                        try:
+                            future.result()
+                        except Exception:
+                            pass
+                shm.close()
+                shm.unlink()
+        
+        print(f"Successfully extracted text from {extracted} pages")
     
-    def create_embeddings(self, chunks: List[str]) -> List[Dict[str, Any]]:
+    def extract_text_from_pdf(self, pdf_source: Union[str, io.BytesIO]) -> List[str]:
         try:
-            print("Creating embeddings...")
-            embedded_chunks = []
-            
-            for i, chunk in enumerate(chunks):
-                try:
-                    # Create embedding
-                    embedding = self.embeddings.embed_query(chunk)
-                    
-                    # Create document with metadata
-                    doc = {
-                        'id': str(uuid.uuid4()),
-                        'values': embedding,
-                        'metadata': {
-                            'content': chunk,
-                            'chunk_index': i,
-                            'total_chunks': len(chunks),
-                            'processed_at': datetime.now().isoformat(),
-                            'source_type': 'pdf'
-                        }
-                    }
-                    embedded_chunks.append(doc)
-                    
-                    if (i + 1) % 10 == 0:
-                        print(f"Created embeddings for {i + 1}/{len(chunks)} chunks")
-                        
-                except Exception as e:
-                    print(f"Error creating embedding for chunk {i}: {e}")
-                    continue
-            
-            print(f"Successfully created {len(embedded_chunks)} embeddings")
-            return embedded_chunks
-            
+            return list(self.iter_page_texts(pdf_source))
         except Exception as e:
-            print(f"Error creating embeddings: {e}")
+            print(f"Error opening PDF: {e}")
             return []
     
-    def push_to_pinecone(self, embedded_chunks: List[Dict[str, Any]], url: str, title: str = None) -> bool:
-        try:
+    def _split_sections(self, text: str, heading: Optional[str]) -> Tuple[List[Tuple[Optional[str], str]], Optional[str]]:
+        """Split a page into (heading, body) sections, returning them with the heading still open at the end"""
+        sections = []
+        body = []
+        for line in text.splitlines():
+            stripped = line.strip()
+            if _HEADING_RE.match(stripped):
+                if body:
+                    sections.append((heading, "\n".join(body)))
+                    body = []
+                heading = stripped
+            else:
+                body.append(line)
+        if body:
+            sections.append((heading, "\n".join(body)))
+        return sections, heading
+    
+    def iter_chunks(self, texts: Iterable[str]) -> Iterator[str]:
+        """Split pages into section-aware chunks lazily, so only the current page is held in memory"""
+        heading = None
+        for text in texts:
+            # A section that runs past the end of a page keeps its heading on the next one
+            sections, heading = self._split_sections(text, heading)
+            for section_heading, body in sections:
+                windows = _token_windows(body, self.config.chunk_tokens, self.config.chunk_overlap_tokens)
+                for chunk, ntokens in windows:
+                    if ntokens < self.config.min_chunk_tokens:
+                        continue
+                    # Prefix the section heading so each chunk carries its context
+                    yield f"{section_heading}\n\n{chunk}" if section_heading else chunk
+    
+    async def _aembed_with_backoff(self, sem: asyncio.Semaphore, texts: List[str]) -> List[List[float]]:
+        async with sem:
+            # Only rate limits and transient errors are retried; a permanent error fails the batch at once
+            retrying = AsyncRetrying(
+                retry=retry_if_exception(is_retryable),
+                wait=wait_retry_after,
+                stop=stop_after_attempt(EMBEDDING_MAX_RETRIES),
+                before_sleep=lambda state: print(
+                    f"Embedding request failed ({state.outcome.exception()}), retrying in {state.next_action.sleep:.0f}s..."
+                ),
+                reraise=True
+            )
+            async for attempt in retrying:
+                with attempt:
+                    return await self.embeddings.aembed_documents(texts)
+    
+    async def _embed_batch(self, sem: asyncio.Semaphore, batch: List[str]) -> np.ndarray:
+        # Headers, footers and repeated descriptions are embedded once and then served from the cache
+        cached = self.embed_cache.get_many(batch)
+        misses = list(dict.fromkeys(chunk for chunk, vector in zip(batch, cached) if vector is None))
+        
+        fresh = {}
+        if misses:
+            vectors = await self._aembed_with_backoff(sem, misses)
+            self.embed_cache.set_many(misses, vectors)
+            fresh = dict(zip(misses, vectors))
+        
+        vectors = [vector if vector is not None else fresh[chunk] for chunk, vector in zip(batch, cached)]
+        # One row per chunk; quantized so batches queued for upload take half the memory
+        return np.asarray(vectors, dtype=self.config.vector_dtype)
+    
+    def _make_doc(self, chunk: str, embedding: np.ndarray, chunk_index: int,
+                  url: str, title: Optional[str], version: int) -> Dict[str, Any]:
+        # total_chunks is left out: it is unknown while chunks are still being streamed
+        return {
+            'id': vector_id(url, version, chunk_index),
+            'values': embedding,
+            'metadata': {
+                'content': chunk,
+                'chunk_index': chunk_index,
+                'processed_at': datetime.now().isoformat(),
+                'source_type': 'pdf',
+                'source_url': url,
+                'title': title or 'PDF Document',
+                'doc_version': version
+            }
+        }
+    
+    def connect_to_pinecone(self) -> bool:
+        # Documents on other threads may be uploading through the open index, so connect only
+        # once rather than swapping in a new index (and its thread pool) per document
+        with self._connect_lock:
+            if self.pinecone_manager.index is not None:
+                return True
+            
             print("Connecting to Pinecone...")
             
             # Connect to existing index or create new one
             success = self.pinecone_manager.connect_to_index()
-            if not success:
+            if success:
+                # Every upsert into an index of another dimension fails, so stop before the first one
+                dimension = self.pinecone_manager.get_index_dimension()
+                if dimension != self.embeddings.dimension:
+                    print(f"Index '{self.pinecone_manager.index_name}' has dimension {dimension}, but the "
+                          f"{self.embeddings.model} backend produces {self.embeddings.dimension}. "
+                          f"Set PINECONE_INDEX_NAME to an index built with this backend.")
+                    self.pinecone_manager.index = None
+                    return False
+            else:
                 print("Creating new Pinecone index...")
-                success = self.pinecone_manager.create_index(dimension=3072)
+                success = self.pinecone_manager.create_index(dimension=self.embeddings.dimension)
             
             if not success:
                 print("Failed to connect to Pinecone")
-                return False
-            
-            # Add URL and title to metadata
-            for chunk in embedded_chunks:
-                chunk['metadata']['source_url'] = url
-                chunk['metadata']['title'] = title or 'PDF Document'
-            
-            # Upload to Pinecone
-            print(f"Uploading {len(embedded_chunks)} embeddings to Pinecone...")
-            success = self.pinecone_manager.upload_vectors(embedded_chunks)
-            
-            if success:
-                print("Successfully uploaded embeddings to Pinecone!")
-                
-                # Show updated stats
-                stats = self.pinecone_manager.get_index_stats()
-                if stats:
-                    print(f"Updated index stats: {stats.get('total_vector_count', 'Unknown')} total vectors")
-                
-                return True
-            else:
-                print("Failed to upload embeddings to Pinecone")
-                return False
+            return success
+    
+    async def parallel_index(self, chunks: Iterable[str], url: str, title: str = None, version: int = 1) -> Tuple[int, int]:
+        """Embed and upload chunks as overlapping pipeline stages, returning (vectors written, batches failed)"""
+        config = self.config
+        # Embed and write workers share the event loop, so plain counters are safe
+        failed = {"batches": 0}
+        chunk_iter = iter(chunks)
+        embed_queue: asyncio.Queue = asyncio.Queue(config.max_queue_size)
+        write_queue: asyncio.Queue = asyncio.Queue(config.max_queue_size)
+        sem = asyncio.Semaphore(config.max_concurrent_batches)
+        
+        def next_batch() -> List[str]:
+            return list(itertools.islice(chunk_iter, config.batch_size))
+        
+        async def batcher():
+            start = 0
+            # Pulling from the chunk stream runs extraction and splitting, so keep it off the event loop
+            batch = await asyncio.to_thread(next_batch)
+            while batch:
+                await embed_queue.put((start, batch))
+                start += len(batch)
+                batch = await asyncio.to_thread(next_batch)
+            # One sentinel per embed worker
+            for _ in range(config.max_concurrent_batches):
+                await embed_queue.put(None)
+        
+        async def embed_worker():
+            while True:
+                item = await embed_queue.get()
+                if item is None:
+                    break
+                start, batch = item
+                try:
+                    vectors = await self._embed_batch(sem, batch)
+                except Exception as e:
+                    print(f"Error creating embeddings for chunks {start}-{start + len(batch) - 1}: {e}")
+                    failed["batches"] += 1
+                    continue
                 
-        except Exception as e:
-            print(f"Error pushing to Pinecone: {e}")
-            return False
+                docs = [
+                    self._make_doc(chunk, embedding, i, url, title, version)
+                    for i, (chunk, embedding) in enumerate(zip(batch, vectors), start)
+                ]
+                await write_queue.put(docs)
+        
+        async def write_worker() -> int:
+            written = 0
+            while True:
+                docs = await write_queue.get()
+                if docs is None:
+                    break
+                # upload_vectors blocks on network I/O, so keep it off the event loop
+                if await asyncio.to_thread(self.pinecone_manager.upload_vectors, docs):
+                    written += len(docs)
+                else:
+                    failed["batches"] += 1
+            return written
+        
+        writer = asyncio.create_task(write_worker())
+        await asyncio.gather(batcher(), *(embed_worker() for _ in range(config.max_concurrent_batches)))
+        await write_queue.put(None)
+        return await writer, failed["batches"]
     
-    def process_pdf_url(self, url: str, title: str = None) -> tuple[bool, int]:
+    def process_pdf_url(self, url: str, title: str = None, version: int = 1) -> tuple[bool, int]:
         try:
             print(f"\n{'='*60}")
             print(f"Processing PDF: {title or 'PDF Document'}")
@@ -163,48 +378,36 @@ class PDFProcessor:
             print(f"{'='*60}")
             
             # Step 1: Download PDF
-            temp_pdf = self.download_pdf(url)
-            if not temp_pdf:
+            pdf_buffer = self.download_pdf(url)
+            if not pdf_buffer:
                 return False, 0
             
+            if not self.connect_to_pinecone():
+                return False, 0
+            
+            # Steps 2-4: Extract, chunk, embed and push to Pinecone as one stream, so
+            # only the batches in flight are ever held in memory
             try:
-                # Step 2: Extract text
-                texts = self.extract_text_from_pdf(temp_pdf)
-                if not texts:
-                    print("No text extracted from PDF")
-                    return False, 0
-                
-                # Step 3: Chunk text
-                chunks = self.chunk_text(texts)
-                if not chunks:
-                    print("No text chunks created")
-                    return False, 0
-                
-                # Step 4: Create embeddings
-                embedded_chunks = self.create_embeddings(chunks)
-                if not embedded_chunks:
-                    print("No embeddings created")
-                    return False, 0
-                
-                # Step 5: Push to Pinecone
-                success = self.push_to_pinecone(embedded_chunks, url, title)
-                
-                chunks_count = len(embedded_chunks)
-                
-                if success:
-                    print(f"\nSuccessfully processed PDF: {chunks_count} chunks added to knowledge base")
-                else:
-                    print(f"\nFailed to process PDF")
-                
-                return success, chunks_count
-                
+                chunks = self.iter_chunks(self.iter_page_texts(pdf_buffer))
+                print("Extracting, embedding and uploading chunks...")
+                chunks_count, failed_batches = asyncio.run(self.parallel_index(chunks, url, title, version))
             finally:
-                # Clean up temporary file
-                try:
-                    os.remove(temp_pdf)
-                    print(f"Cleaned up temporary file: {temp_pdf}")
-                except:
-                    pass
+                pdf_buffer.close()
+            # A partly indexed document is a failure, so it is retried rather than skipped as done
+            success = chunks_count > 0 and failed_batches == 0
+            
+            if success:
+                stats = self.pinecone_manager.get_index_stats()
+                if stats:
+                    print(f"Updated index stats: {stats.get('total_vector_count', 'Unknown')} total vectors")
+                
+                print(f"\nSuccessfully processed PDF: {chunks_count} chunks added to knowledge base")
+            elif failed_batches:
+                print(f"\nFailed to process PDF: {failed_batches} batches failed, {chunks_count} chunks written")
+            else:
+                print(f"\nFailed to process PDF")
+            
+            return success, chunks_count
                     
         except Exception as e:
             print(f"Error in PDF processing pipeline: {e}")
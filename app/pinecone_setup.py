@@ -4,24 +4,101 @@ Creates index and uploads vectorized data
 """
 
 import os
-import json
 import time
-from typing import List, Dict, Any
+import orjson
+import itertools
+import threading
+from collections import deque
+from typing import List, Dict, Any, Iterable, Iterator
 from dotenv import load_dotenv
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
-from langchain_pinecone import PineconeVectorStore
-from langchain.chains import RetrievalQA
-from langchain.prompts import PromptTemplate
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+from operator import itemgetter
+from app.embedding_backends import get_embedding_backend
 
 # Load environment variables
 load_dotenv()
 
+# The gRPC client has higher upsert throughput but a heavier import, so it is opt-in
+USE_GRPC = os.getenv("USE_GRPC", "").lower() in ("1", "true", "yes")
+
 try:
-    from pinecone import Pinecone, ServerlessSpec
+    from pinecone import ServerlessSpec
+    from pinecone.exceptions import PineconeApiException
+    if USE_GRPC:
+        from pinecone.grpc import PineconeGRPC as Pinecone
+    else:
+        from pinecone import Pinecone
     PINECONE_AVAILABLE = True
 except ImportError:
     PINECONE_AVAILABLE = False
-    print("Warning: Pinecone not installed. Install with: pip install pinecone")
+    if USE_GRPC:
+        print("Warning: Pinecone gRPC client not installed. Install with: pip install \"pinecone[grpc]\"")
+    else:
+        print("Warning: Pinecone not installed. Install with: pip install pinecone")
+
+# Seconds to wait for a newly created index to report ready
+INDEX_READY_TIMEOUT = 120
+
+# Upsert failures worth retrying: throttling and transient server errors
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+def _is_retryable(exc: BaseException) -> bool:
+    return isinstance(exc, PineconeApiException) and getattr(exc, "status", None) in RETRYABLE_STATUSES
+
+def _is_rate_limited(exc: BaseException) -> bool:
+    return isinstance(exc, PineconeApiException) and getattr(exc, "status", None) == 429
+
+class UpsertThrottle:
+    """Sliding-window request rate limit that only engages after Pinecone returns 429"""
+    
+    def __init__(self, window: float = 1.0, cooldown: float = 30.0):
+        self.window = window
+        self.cooldown = cooldown
+        self.sent = deque()
+        self.limit = None
+        self.last_429 = 0.0
+        # Documents upload from several threads through one manager
+        self.lock = threading.Lock()
+    
+    def _trim(self, now: float):
+        while self.sent and now - self.sent[0] > self.window:
+            self.sent.popleft()
+    
+    def record_429(self):
+        """Cap the rate a little below what was being sent when the 429 arrived"""
+        with self.lock:
+            now = time.monotonic()
+            self._trim(now)
+            self.limit = max(1, int(len(self.sent) * 0.8))
+            self.last_429 = now
+    
+    def wait(self):
+        """Block until another request fits in the window; free while no 429 has been seen"""
+        with self.lock:
+            now = time.monotonic()
+            if self.limit is not None and now - self.last_429 > self.cooldown:
+                self.limit = None
+            self._trim(now)
+            if self.limit is not None:
+                while len(self.sent) >= self.limit:
+                    time.sleep(max(self.window - (now - self.sent[0]), 0.01))
+                    now = time.monotonic()
+                    self._trim(now)
+            self.sent.append(now)
+
+def _wait_for(async_result):
+    """Block on an async upsert; REST returns an ApplyResult, gRPC a Future"""
+    if hasattr(async_result, "result"):
+        return async_result.result()
+    return async_result.get()
+
+def chunks(iterable: Iterable, batch_size: int = 100) -> Iterator[tuple]:
+    """Yield successive batch_size-sized tuples from an iterable"""
+    it = iter(iterable)
+    batch = tuple(itertools.islice(it, batch_size))
+    while batch:
+        yield batch
+        batch = tuple(itertools.islice(it, batch_size))
 
 class PineconeManager:
     
@@ -32,6 +109,7 @@ class PineconeManager:
         self.api_key = os.getenv("PINECONE_API_KEY")
         self.environment = os.getenv("PINECONE_ENVIRONMENT", "us-east-1-aws")  # Default environment
         self.index_name = os.getenv("PINECONE_INDEX_NAME", "ai-advisor-index")
+        self.pool_threads = int(os.getenv("PINECONE_POOL_THREADS", "20"))
         
         if not self.api_key:
             raise ValueError("PINECONE_API_KEY not found in environment variables")
@@ -39,16 +117,46 @@ class PineconeManager:
         # Initialize Pinecone
         self.pc = Pinecone(api_key=self.api_key)
         self.index = None
+        self._existing_indexes = None
+        self.throttle = UpsertThrottle()
+    
+    def _open_index(self):
+        """Open the index with a thread pool so upserts can run in parallel"""
+        return self.pc.Index(self.index_name, pool_threads=self.pool_threads)
+    
+    def _list_index_names(self, refresh: bool = False) -> List[str]:
+        """Index names, fetched once so connect-then-create does not list twice"""
+        if refresh or self._existing_indexes is None:
+            self._existing_indexes = [index.name for index in self.pc.list_indexes()]
+        return self._existing_indexes
+    
+    def get_index_dimension(self):
+        """Vector dimension of the index, or None if it cannot be described"""
+        try:
+            return self.pc.describe_index(self.index_name).dimension
+        except Exception as e:
+            print(f"Error describing index: {e}")
+            return None
+    
+    def _wait_until_ready(self) -> bool:
+        delay = 0.25
+        deadline = time.monotonic() + INDEX_READY_TIMEOUT
+        while not self.pc.describe_index(self.index_name).status.ready:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, 8)
+        return True
     
     def create_index(self, dimension: int = 3072, metric: str = "cosine"):
         """Create a new Pinecone index"""
         try:
             # Check if index already exists
-            existing_indexes = [index.name for index in self.pc.list_indexes()]
+            existing_indexes = self._list_index_names()
             
             if self.index_name in existing_indexes:
                 print(f"Index '{self.index_name}' already exists")
-                self.index = self.pc.Index(self.index_name)
+                self.index = self._open_index()
                 return True
             
             # Create new index with serverless spec
@@ -60,15 +168,18 @@ class PineconeManager:
                 spec=ServerlessSpec(
                     cloud='aws',
                     region=self.environment
-                )
+                ),
+                timeout=-1  # Return immediately; readiness is polled below
             )
             
-            # Wait for index to be ready
+            # Wait for index to be ready, backing off so we return soon after it flips
             print("Waiting for index to be ready...")
-            while self.index_name not in [index.name for index in self.pc.list_indexes()]:
-                time.sleep(1)
+            if not self._wait_until_ready():
+                print(f"Index '{self.index_name}' was not ready after {INDEX_READY_TIMEOUT}s")
+                return False
             
-            self.index = self.pc.Index(self.index_name)
+            existing_indexes.append(self.index_name)
+            self.index = self._open_index()
             print(f"Index '{self.index_name}' created successfully!")
             return True
             
@@ -79,12 +190,12 @@ class PineconeManager:
     def connect_to_index(self):
         """Connect to existing index"""
         try:
-            existing_indexes = [index.name for index in self.pc.list_indexes()]
+            existing_indexes = self._list_index_names(refresh=True)
             if self.index_name not in existing_indexes:
                 print(f"Index '{self.index_name}' does not exist. Create it first.")
                 return False
             
-            self.index = self.pc.Index(self.index_name)
+            self.index = self._open_index()
             print(f"Connected to index '{self.index_name}'")
             return True
             
@@ -92,34 +203,75 @@ class PineconeManager:
             print(f"Error connecting to index: {e}")
             return False
     
+    @retry(
+        retry=retry_if_exception(_is_retryable),
+        wait=wait_exponential_jitter(initial=0.5, max=8),
+        stop=stop_after_attempt(6),
+        reraise=True
+    )
+    def _upsert_with_retry(self, vectors: List[Dict[str, Any]]):
+        """Synchronous upsert, retried with jittered backoff on 429 and 5xx"""
+        self.throttle.wait()
+        try:
+            return self.index.upsert(vectors=vectors)
+        except Exception as e:
+            if _is_rate_limited(e):
+                self.throttle.record_429()
+            raise
+    
+    def _finish_upsert(self, async_result, vectors: List[Dict[str, Any]]):
+        """Wait on an async upsert, resending the batch through the retry path if it was throttled"""
+        try:
+            return _wait_for(async_result)
+        except Exception as e:
+            if not _is_retryable(e):
+                raise
+            if _is_rate_limited(e):
+                self.throttle.record_429()
+            return self._upsert_with_retry(vectors)
+    
     def upload_vectors(self, vectors: List[Dict[str, Any]], batch_size: int = 100):
-        """Upload vectors to Pinecone in batches"""
+        """Upload vectors to Pinecone in parallel batches"""
+        total_vectors = len(vectors)
+        print(f"Uploading {total_vectors} vectors in batches of {batch_size}...")
+        return self.upload_batches(chunks(vectors, batch_size), total_batches=(total_vectors - 1) // batch_size + 1)
+    
+    def upload_batches(self, batches: Iterable[List[Dict[str, Any]]], total_batches: int = None):
+        """Upload pre-batched vectors in parallel, pulling each batch from the iterable only when it is sent"""
         if not self.index:
             print("No index connected. Create or connect to an index first.")
             return False
         
         try:
-            total_vectors = len(vectors)
-            print(f"Uploading {total_vectors} vectors in batches of {batch_size}...")
+            of_total = f"/{total_batches}" if total_batches else ""
             
-            for i in range(0, total_vectors, batch_size):
-                batch = vectors[i:i + batch_size]
-                
+            # Keep at most pool_threads upserts in flight to stay clear of rate limits
+            pending = deque()
+            completed = 0
+            for batch in batches:
                 # Format for Pinecone upload
-                formatted_vectors = []
-                for vector in batch:
-                    formatted_vectors.append({
+                formatted_vectors = [
+                    {
                         'id': vector['id'],
-                        'values': vector['values'],
+                        # Vectors may be held as numpy arrays; Pinecone wants plain lists
+                        'values': vector['values'].tolist() if hasattr(vector['values'], 'tolist') else vector['values'],
                         'metadata': vector['metadata']
-                    })
+                    }
+                    for vector in batch
+                ]
                 
-                # Upload batch
-                self.index.upsert(vectors=formatted_vectors)
-                print(f"Uploaded batch {i//batch_size + 1}/{(total_vectors-1)//batch_size + 1}")
-                
-                # Small delay to avoid rate limits
-                time.sleep(0.1)
+                if len(pending) >= self.pool_threads:
+                    self._finish_upsert(*pending.popleft())
+                    completed += 1
+                    print(f"Uploaded batch {completed}{of_total}")
+                self.throttle.wait()
+                pending.append((self.index.upsert(vectors=formatted_vectors, async_req=True), formatted_vectors))
+            
+            # Wait for the remaining batches; this re-raises any upsert error that retries could not clear
+            while pending:
+                self._finish_upsert(*pending.popleft())
+                completed += 1
+                print(f"Uploaded batch {completed}{of_total}")
             
             print("All vectors uploaded successfully!")
             return True
@@ -128,6 +280,26 @@ class PineconeManager:
             print(f"Error uploading vectors: {e}")
             return False
     
+    def delete_by_prefix(self, prefix: str, keep_prefix: str = None) -> int:
+        """Delete vectors whose ID starts with prefix, except those starting with keep_prefix"""
+        if not self.index:
+            print("No index connected. Create or connect to an index first.")
+            return 0
+        
+        try:
+            deleted = 0
+            # Listing by ID prefix is what serverless indexes support in place of delete-by-filter
+            for ids in self.index.list(prefix=prefix):
+                stale = [vid for vid in ids if not (keep_prefix and vid.startswith(keep_prefix))]
+                if stale:
+                    self.index.delete(ids=stale)
+                    deleted += len(stale)
+            return deleted
+            
+        except Exception as e:
+            print(f"Error deleting vectors with prefix '{prefix}': {e}")
+            return 0
+    
     def query_index(self, query_vector: List[float], top_k: int = 5, include_metadata: bool = True):
         """Query the index for similar vectors"""
         if not self.index:
@@ -180,6 +352,13 @@ class PineconeManager:
     def create_rag_chain(self, retriever, system_prompt=None):
         """Create a RAG chain using a retriever and an LLM with optional system prompt"""
         try:
+            # Imported here: every PDF extraction worker re-imports the entry script's modules,
+            # and none of them needs langchain
+            from langchain_openai import ChatOpenAI
+            from langchain_core.prompts import PromptTemplate
+            from langchain_core.output_parsers import StrOutputParser
+            from langchain_core.runnables import RunnableParallel
+            
             # Initialize the LLM
             llm = ChatOpenAI(model="gpt-4o-mini")
 
@@ -189,7 +368,7 @@ class PineconeManager:
                 If the answer cannot be found in the context, say so clearly. 
                 Provide detailed, well-structured responses based on the available information."""
 
-            # Create the RetrievalQA chain with custom prompt
+            # Create the prompt for the RAG chain
             prompt_template = f"""{system_prompt}
 
 Context: {{context}}
@@ -203,12 +382,16 @@ Answer:"""
                 input_variables=["context", "question"]
             )
 
-            rag_chain = RetrievalQA.from_chain_type(
-                llm=llm,
-                chain_type="stuff",
-                retriever=retriever,
-                chain_type_kwargs={"prompt": prompt},
-                return_source_documents=True
+            def format_context(inputs):
+                return "\n\n".join(doc.page_content for doc in inputs["source_documents"])
+
+            # Takes {"question"}; retrieves once, then streams {"source_documents"} followed by
+            # {"answer"} token chunks, so callers can show sources without a second search
+            rag_chain = RunnableParallel(
+                source_documents=itemgetter("question") | retriever,
+                question=itemgetter("question")
+            ).assign(
+                answer={"context": format_context, "question": itemgetter("question")} | prompt | llm | StrOutputParser()
             )
 
             # Return the callable chain
@@ -218,28 +401,29 @@ Answer:"""
             print(f"Error creating RAG chain: {e}")
             return None
 
-def load_scraped_data(filename: str = "app/scraped_data.json") -> List[Dict[str, Any]]:
-    """Load scraped data from JSON file"""
+def load_scraped_data(filename: str = "app/scraped_data.jsonl") -> List[Dict[str, Any]]:
+    """Load scraped data from a newline-delimited JSON file"""
     try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        
-        # Convert to Pinecone format
+        # Convert to Pinecone format, one line at a time
         vectors = []
-        for item in data:
-            vector = {
-                'id': item['id'],
-                'values': item['embedding'],
-                'metadata': {
-                    'source_url': item['source_url'],
-                    'title': item['title'],
-                    'content': item['content'][:1000],  # Limit metadata size
-                    'chunk_index': item['chunk_index'],
-                    'total_chunks': item['total_chunks'],
-                    'scraped_at': item['scraped_at']
+        with open(filename, 'rb') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                item = orjson.loads(line)
+                vector = {
+                    'id': item['id'],
+                    'values': item['embedding'],
+                    'metadata': {
+                        'source_url': item['source_url'],
+                        'title': item['title'],
+                        'content': item['content'][:1000],  # Limit metadata size
+                        'chunk_index': item['chunk_index'],
+                        'total_chunks': item['total_chunks'],
+                        'scraped_at': item['scraped_at']
+                    }
                 }
-            }
-            vectors.append(vector)
+                vectors.append(vector)
         
         return vectors
         
@@ -257,8 +441,8 @@ def main():
         # Initialize Pinecone manager
         manager = PineconeManager()
         
-        # Create or connect to index (using dimension 3072 for text-embedding-3-large)
-        success = manager.create_index(dimension=3072)
+        # Create or connect to index, sized for the configured embedding backend
+        success = manager.create_index(dimension=get_embedding_backend().dimension)
         if not success:
             success = manager.connect_to_index()
         
@@ -267,7 +451,7 @@ def main():
             return
         
         # Load scraped data
-        vectors = load_scraped_data("app/scraped_data.json")
+        vectors = load_scraped_data("app/scraped_data.jsonl")
         
         if not vectors:
             print("No scraped data found. Run scraper.py first to generate data.")
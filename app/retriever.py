@@ -1,34 +1,109 @@
 import os
-from langchain_openai import OpenAIEmbeddings
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Any
+from langchain_core.embeddings import Embeddings
 from langchain_pinecone import PineconeVectorStore
+from pinecone import Pinecone
 from dotenv import load_dotenv
+from app.embedding_backends import EmbeddingBackend, get_embedding_backend
 
 load_dotenv()
 
+class CachedQueryEmbeddings(Embeddings):
+    """Embeddings wrapper that memoizes query vectors on case- and whitespace-normalized text"""
+    
+    def __init__(self, embeddings: EmbeddingBackend, maxsize: int = 1024):
+        self.embeddings = embeddings
+        self.maxsize = maxsize
+        # Normalized text -> vector, least recently used first; shared by Streamlit sessions
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+    
+    def embed_query(self, text: str) -> List[float]:
+        # Keyed on the normalized form, but the API sees the caller's text, so "CSC 3320" keeps its case
+        key = " ".join(text.lower().split())
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return list(self._cache[key])
+        
+        # Tuples so cached vectors cannot be mutated by a caller
+        vector = tuple(self.embeddings.embed_query(text))
+        with self._lock:
+            self._cache[key] = vector
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return list(vector)
+
 class RetrieverSetup:
     def __init__(self, index_name):
         self.index_name = index_name
         self.api_key = os.getenv("PINECONE_API_KEY")
+        # Created once and shared by every query this instance serves; repeated
+        # questions, from retrieve() or the vector store, skip the embeddings round-trip.
+        # Queries use the same EMBEDDING_BACKEND as ingest, so they match the index's vectors
+        self.embeddings = CachedQueryEmbeddings(get_embedding_backend())
+        # Opened on first use, where a missing index or network failure is reported instead of raised
+        self.index = None
+    
+    def _get_index(self):
+        """Pinecone index client shared by retrieve() and the vector store, or None if it cannot be opened"""
+        if self.index is None:
+            if not self.api_key:
+                print("Error: PINECONE_API_KEY not found in environment variables")
+                return None
+            try:
+                self.index = Pinecone(api_key=self.api_key).Index(self.index_name)
+            except Exception as e:
+                print(f"Error opening index '{self.index_name}': {e}")
+                return None
+        return self.index
+    
+    def embed_query(self, query: str) -> List[float]:
+        """Query embedding, served from the in-process cache when the text repeats"""
+        return self.embeddings.embed_query(query)
+    
+    def retrieve(self, query: str, k: int = 5) -> List[Dict[str, Any]]:
+        """Query Pinecone directly and return plain dicts with content, score and metadata"""
+        index = self._get_index()
+        if index is None:
+            return []
+        
+        try:
+            results = index.query(vector=self.embed_query(query), top_k=k, include_metadata=True)
+            return [
+                {
+                    "id": match.id,
+                    "score": match.score,
+                    "content": (match.metadata or {}).get("content", ""),
+                    "metadata": match.metadata or {}
+                }
+                for match in results.matches
+            ]
+            
+        except Exception as e:
+            print(f"Error retrieving documents: {e}")
+            return []
         
     def setup_retriever(self):
         try:
             print(f"Setting up retriever for index: {self.index_name}")
             
-            # Check if API key is available
-            if not self.api_key:
-                print("Error: PINECONE_API_KEY not found in environment variables")
+            # Check the API key and that the index can be opened
+            index = self._get_index()
+            if index is None:
                 return None
             
-            # Initialize OpenAI embeddings with the correct model for 3072 dimensions
-            print("Initializing OpenAI embeddings...")
-            embeddings = OpenAIEmbeddings(model="text-embedding-3-large")
-            
             print(f"Creating vector store for index '{self.index_name}'...")
             
-            # Create a Pinecone vector store from the existing index using the new API
+            # Create a Pinecone vector store over the same index client retrieve() uses
             vector_store = PineconeVectorStore(
-                index_name=self.index_name,
-                embedding=embeddings,
+                index=index,
+                embedding=self.embeddings,
                 text_key="content"  # This is the key name used in your stored data
             )
             
@@ -49,23 +124,18 @@ class RetrieverSetup:
     def test_retriever(self, query="economics classes"):
         """Test the retriever to see if it can find relevant documents"""
         try:
-            retriever = self.setup_retriever()
-            if not retriever:
-                print("Failed to setup retriever")
-                return False
-                
             print(f"Testing retriever with query: '{query}'")
             
             # Test retrieval
-            docs = retriever.get_relevant_documents(query)
+            docs = self.retrieve(query)
             
             print(f"Found {len(docs)} documents")
             
             if docs:
                 print("\n--- Sample Retrieved Document ---")
-                print(f"Content preview: {docs[0].page_content[:200]}...")
-                if hasattr(docs[0], 'metadata') and docs[0].metadata:
-                    print(f"Metadata: {docs[0].metadata}")
+                print(f"Content preview: {docs[0]['content'][:200]}...")
+                if docs[0]['metadata']:
+                    print(f"Metadata: {docs[0]['metadata']}")
                 print("--- End Sample ---\n")
                 return True
             else:
@@ -1,74 +1,179 @@
 import os
+import re
+import hashlib
+import itertools
 import requests
-import time
-from typing import List, Dict, Any
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from typing import List, Dict, Any, Optional, Iterator
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
 import openai
-import json
+import orjson
+import numpy as np
+import tiktoken
 from datetime import datetime
 
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from tenacity import Retrying, retry_if_exception, stop_after_attempt
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from app.embedding_cache import EmbeddingCache
+from app.embedding_backends import get_embedding_backend, is_retryable, wait_retry_after
+from app.pinecone_setup import PineconeManager
 
 load_dotenv()
 
+# The embeddings endpoint accepts at most 2048 inputs per request
+MAX_EMBED_BATCH_SIZE = 2048
+EMBEDDING_DIMENSION = 3072  # text-embedding-3-large
+# Loaded once; building the encoder per call would dominate short splits
+_ENC = tiktoken.get_encoding("cl100k_base")  # text-embedding-3-large tokenizer
+
+def _ntokens(text: str) -> int:
+    return len(_ENC.encode(text))
+
+_WS_RE = re.compile(r"\s+")
+
+# Characters of chunk text kept as Pinecone metadata
+MAX_METADATA_CONTENT = 1000
+
+# Main content areas, tried in a single pass over the page
+CONTENT_SELECTOR = "main, article, .content, #content, .main-content, .post-content, .entry-content"
+
+def _call_with_backoff(fn, *args, max_retries: int = 6, **kwargs):
+    """Call fn, retrying rate limits, timeouts, connection errors and 5xx; the last error is re-raised"""
+    retrying = Retrying(
+        retry=retry_if_exception(is_retryable),
+        wait=wait_retry_after,
+        stop=stop_after_attempt(max_retries),
+        reraise=True
+    )
+    return retrying(fn, *args, **kwargs)
+
 class OpenAIEmbeddings:
-    def __init__(self, api_key: str = None):
+    def __init__(self, api_key: str = None, batch_size: int = None, max_concurrency: int = 5):
         self.api_key = api_key or os.getenv("OPENAI_API_KEY")
+        batch_size = batch_size or int(os.getenv("OPENAI_EMBED_BATCH_SIZE", "256"))
+        self.batch_size = max(1, min(batch_size, MAX_EMBED_BATCH_SIZE))
+        self.max_concurrency = max_concurrency
         if not self.api_key:
             raise ValueError("OpenAI API key not found. Please set OPENAI_API_KEY environment variable.")
         
-        self.client = openai.OpenAI(api_key=self.api_key)
+        # Retries are handled by _call_with_backoff rather than the client
+        self.client = openai.OpenAI(api_key=self.api_key, max_retries=0)
+        # Repeated boilerplate and re-scrapes are served from disk instead of the API
+        self.cache = EmbeddingCache(model="text-embedding-3-large")
     
-    def embed_documents(self, texts: List[str]) -> List[List[float]]:
-        """Generate embeddings for multiple documents"""
-        embeddings = []
+    def _embed_batch(self, batch: List[str], out: np.ndarray):
+        """Embed a batch in one request into out's rows, halving it on a rejected input to find the one at fault"""
+        try:
+            response = _call_with_backoff(
+                self.client.embeddings.create,
+                input=batch,
+                model="text-embedding-3-large"
+            )
+            # Results carry their input index; write each straight into its row
+            for d in response.data:
+                out[d.index] = d.embedding
+        except openai.BadRequestError:
+            # A single rejected text is an error for the caller, never a zero vector in the index
+            if len(batch) == 1:
+                raise
+            mid = len(batch) // 2
+            self._embed_batch(batch[:mid], out[:mid])
+            self._embed_batch(batch[mid:], out[mid:])
+    
+    def _embed_uncached(self, texts: List[str]) -> np.ndarray:
+        """Embed texts through the API in concurrent batches, one float32 row per text in input order"""
+        embeddings = np.empty((len(texts), EMBEDDING_DIMENSION), dtype=np.float32)
+        starts = range(0, len(texts), self.batch_size)
+        batches = [texts[start:start + self.batch_size] for start in starts]
+        # Each batch fills a view of the shared matrix, so no per-batch lists are assembled
+        views = [embeddings[start:start + self.batch_size] for start in starts]
+        if len(batches) == 1:
+            self._embed_batch(batches[0], views[0])
+            return embeddings
         
-        for text in texts:
-            try:
-                response = self.client.embeddings.create(
-                    input=text,
-                    model="text-embedding-3-large"
-                )
-                embeddings.append(response.data[0].embedding)
-                time.sleep(0.1)  # Rate limiting
-            except Exception as e:
-                print(f"Error generating embedding: {e}")
-                embeddings.append([0.0] * 3072)  # text-embedding-3-large dimension
+        # Requests are network-bound, so a few threads overlap their latency
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            # Consuming the results re-raises the first failed batch
+            list(executor.map(self._embed_batch, batches, views))
+        
+        return embeddings
+    
+    def embed_documents(self, texts: List[str]) -> np.ndarray:
+        """Generate embeddings for multiple documents as a float32 matrix, one row per text"""
+        cached = self.cache.get_many(texts)
+        embeddings = np.empty((len(texts), EMBEDDING_DIMENSION), dtype=np.float32)
+        
+        hit_rows = [i for i, vector in enumerate(cached) if vector is not None]
+        if hit_rows:
+            embeddings[hit_rows] = np.stack([cached[i] for i in hit_rows])
+        
+        miss_rows = [i for i, vector in enumerate(cached) if vector is None]
+        if miss_rows:
+            misses = list(dict.fromkeys(texts[i] for i in miss_rows))
+            fresh = self._embed_uncached(misses)
+            self.cache.set_many(misses, fresh)
+            position = {text: j for j, text in enumerate(misses)}
+            embeddings[miss_rows] = fresh[[position[texts[i]] for i in miss_rows]]
         
         return embeddings
     
     def embed_query(self, text: str) -> List[float]:
         """Generate embedding for a single query"""
-        return self.embed_documents([text])[0]
+        return self.embed_documents([text])[0].tolist()
 
 class WebScraper:
     """Web scraper with chunking and embedding capabilities"""
     
-    def __init__(self, chunk_size: int = 1000, chunk_overlap: int = 200):
+    def __init__(self, chunk_size: int = 800, chunk_overlap: int = 120, max_concurrency: int = 5,
+                 max_fetch_workers: int = 8, max_per_host: int = 2):
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
+        # Sizes are in tokens, so chunks pack to the embedding model's budget
         self.text_splitter = RecursiveCharacterTextSplitter(
             chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap
+            chunk_overlap=chunk_overlap,
+            length_function=_ntokens
         )
-        self.embeddings = OpenAIEmbeddings()
+        # Vectors must match the index's backend; the batched, cached client below is the OpenAI path
+        if os.getenv("EMBEDDING_BACKEND", "openai").lower() == "openai":
+            self.embeddings = OpenAIEmbeddings(max_concurrency=max_concurrency)
+        else:
+            self.embeddings = get_embedding_backend()
         self.scraped_data = []
+        self.max_fetch_workers = max_fetch_workers
+        # Pooled connections are reused across pages instead of a new TCP/TLS handshake per URL
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+        self.session.headers['User-Agent'] = (
+            'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+        )
+        # Cap concurrent requests per host so parallel scraping stays polite
+        self.max_per_host = max_per_host
+        self._host_slots = {}
+        self._host_slots_lock = threading.Lock()
+    
+    def _host_slot(self, url: str) -> threading.BoundedSemaphore:
+        host = urlparse(url).netloc
+        with self._host_slots_lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._host_slots[host]
     
     def scrape_url(self, url: str) -> Dict[str, Any]:
         """Scrape a single URL and return structured data"""
         try:
             print(f"Scraping: {url}")
             
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-            }
-            
-            response = requests.get(url, headers=headers, timeout=30)
+            with self._host_slot(url):
+                response = self.session.get(url, timeout=30)
             response.raise_for_status()
             
-            # Parse HTML
-            soup = BeautifulSoup(response.content, 'html.parser')
+            # Parse HTML with the C-based lxml parser
+            soup = BeautifulSoup(response.content, 'lxml')
             
             # Remove script and style elements
             for script in soup(["script", "style"]):
@@ -78,26 +183,19 @@ class WebScraper:
             title = soup.find('title')
             title_text = title.get_text().strip() if title else "No Title"
             
-            # Get main content (try to find main content areas)
-            content_selectors = [
-                'main', 'article', '.content', '#content', 
-                '.main-content', '.post-content', '.entry-content'
-            ]
-            
-            content_text = ""
-            for selector in content_selectors:
-                content_elem = soup.select_one(selector)
-                if content_elem:
-                    content_text = content_elem.get_text()
-                    break
+            # Get main content: one combined selector walks the tree once, first match in document order
+            content_elem = soup.select_one(CONTENT_SELECTOR)
             
             # If no main content found, get body text
-            if not content_text:
-                body = soup.find('body')
+            if content_elem:
+                content_text = content_elem.get_text()
+            else:
+                body = soup.body
                 content_text = body.get_text() if body else soup.get_text()
             
             # Clean up text
-            content_text = ' '.join(content_text.split())
+            # One regex pass, without materializing a list of every word on the page
+            content_text = _WS_RE.sub(" ", content_text).strip()
             
             return {
                 'url': url,
@@ -121,60 +219,85 @@ class WebScraper:
     def process_urls(self, urls: List[str]) -> List[Dict[str, Any]]:
         """Scrape multiple URLs and process them into chunks with embeddings"""
         all_chunks = []
+        # Navigation and boilerplate repeat across pages; each distinct chunk is embedded once per run
+        embedded = {}
         
-        for url in urls:
-            scraped_data = self.scrape_url(url)
-            
-            if scraped_data['success'] and scraped_data['content']:
-                chunks = self.text_splitter.split_text(scraped_data['content'])
-                print(f"Created {len(chunks)} chunks from {url}")
-                
-                # Generate embeddings for chunks
-                print("Generating embeddings...")
-                embeddings = self.embeddings.embed_documents(chunks)
-                
-                # Create chunk objects
-                for i, (chunk, embedding) in enumerate(zip(chunks, embeddings)):
-                    chunk_data = {
-                        'id': f"{url}_{i}",
-                        'source_url': url,
-                        'title': scraped_data['title'],
-                        'content': chunk,
-                        'embedding': embedding,
-                        'chunk_index': i,
-                        'total_chunks': len(chunks),
-                        'scraped_at': scraped_data['scraped_at']
-                    }
-                    all_chunks.append(chunk_data)
-            time.sleep(0.1)
+        # Fetch pages concurrently; embedding consumes them in input order as they arrive
+        with ThreadPoolExecutor(max_workers=self.max_fetch_workers) as executor:
+            scraped_pages = executor.map(self.scrape_url, urls)
+            for url, scraped_data in zip(urls, scraped_pages):
+                if scraped_data['success'] and scraped_data['content']:
+                    chunks = self.text_splitter.split_text(scraped_data['content'])
+                    print(f"Created {len(chunks)} chunks from {url}")
+                    
+                    digests = [hashlib.sha1(chunk.encode("utf-8")).digest() for chunk in chunks]
+                    unique = {d: chunk for d, chunk in zip(digests, chunks) if d not in embedded}
+                    
+                    # Generate embeddings for chunks not already seen on an earlier page
+                    print(f"Generating embeddings for {len(unique)} new chunks...")
+                    try:
+                        if unique:
+                            vectors = np.asarray(self.embeddings.embed_documents(list(unique.values())), dtype=np.float32)
+                            embedded.update(zip(unique, vectors))
+                    except Exception as e:
+                        # Skip the page rather than storing placeholder vectors for it
+                        print(f"Error generating embeddings for {url}: {e}")
+                        continue
+                    
+                    # Create chunk objects; every occurrence keeps its own vector and metadata
+                    for i, (chunk, digest) in enumerate(zip(chunks, digests)):
+                        embedding = embedded[digest]
+                        chunk_data = {
+                            'id': f"{url}_{i}",
+                            'source_url': url,
+                            'title': scraped_data['title'],
+                            # Truncated once here, to what Pinecone metadata will hold
+                            'content': chunk[:MAX_METADATA_CONTENT],
+                            'embedding': embedding,
+                            'chunk_index': i,
+                            'total_chunks': len(chunks),
+                            'scraped_at': scraped_data['scraped_at']
+                        }
+                        all_chunks.append(chunk_data)
+        
+        if all_chunks:
+            duplicates = len(all_chunks) - len(embedded)
+            print(f"Deduplicated {duplicates}/{len(all_chunks)} chunks ({duplicates / len(all_chunks):.0%})")
         
         self.scraped_data = all_chunks
         return all_chunks
     
-    def save_to_json(self, filename: str = "scraped_data.json"):
-        """Save scraped data to JSON file"""
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(self.scraped_data, f, indent=2, ensure_ascii=False)
+    def save_to_json(self, filename: str = "scraped_data.jsonl"):
+        """Save scraped data as newline-delimited JSON, one chunk per line"""
+        # Serializing chunk by chunk avoids building the whole float-heavy document in memory
+        with open(filename, 'wb') as f:
+            for chunk in self.scraped_data:
+                f.write(orjson.dumps(chunk, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_SERIALIZE_NUMPY))
         print(f"Data saved to {filename}")
     
-    def get_pinecone_vectors(self) -> List[Dict[str, Any]]:
-        """Format data for Pinecone upload"""
-        vectors = []
-        for chunk in self.scraped_data:
-            vector = {
-                'id': chunk['id'],
-                'values': chunk['embedding'],
-                'metadata': {
-                    'source_url': chunk['source_url'],
-                    'title': chunk['title'],
-                    'content': chunk['content'][:1000],  # Limit metadata size
-                    'chunk_index': chunk['chunk_index'],
-                    'total_chunks': chunk['total_chunks'],
-                    'scraped_at': chunk['scraped_at']
-                }
+    def _to_pinecone_vector(self, chunk: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            'id': chunk['id'],
+            # Pinecone takes plain lists; keep float32 arrays until the batch is about to be sent
+            'values': chunk['embedding'].tolist(),
+            'metadata': {
+                'source_url': chunk['source_url'],
+                'title': chunk['title'],
+                'content': chunk['content'],
+                'chunk_index': chunk['chunk_index'],
+                'total_chunks': chunk['total_chunks'],
+                'scraped_at': chunk['scraped_at']
             }
-            vectors.append(vector)
-        return vectors
+        }
+    
+    def iter_pinecone_batches(self, batch_size: int = 100) -> Iterator[List[Dict[str, Any]]]:
+        """Yield upload-ready batches, converting embeddings only as each batch is produced"""
+        it = iter(self.scraped_data)
+        batch = list(itertools.islice(it, batch_size))
+        while batch:
+            # Each batch can go straight to PineconeManager.upload_batches
+            yield [self._to_pinecone_vector(chunk) for chunk in batch]
+            batch = list(itertools.islice(it, batch_size))
 
 def main():
     urls = [
@@ -187,20 +310,33 @@ def main():
         return
     
     # Initialize scraper
-    scraper = WebScraper(chunk_size=1000, chunk_overlap=200)
+    scraper = WebScraper(chunk_size=800, chunk_overlap=120)
     
     # Process URLs
     chunks = scraper.process_urls(urls)
     print(f"\nProcessed {len(chunks)} total chunks from {len(urls)} URLs")
     
     # Save to JSON
-    scraper.save_to_json("app/scraped_data.json")
+    scraper.save_to_json("app/scraped_data.jsonl")
+    
+    if not chunks:
+        return scraper
+    
+    # Upload to Pinecone batch by batch, so the converted vectors never exist all at once
+    try:
+        manager = PineconeManager()
+        connected = manager.connect_to_index()
+    except Exception as e:
+        print(f"Error connecting to Pinecone: {e}")
+        connected = False
+    if not connected:
+        print("Vectors were saved; run pinecone_setup.py to upload them")
+        return scraper
     
-    # Get vectors for Pinecone
-    vectors = scraper.get_pinecone_vectors()
-    print(f"Ready to upload {len(vectors)} vectors to Pinecone")
+    total_batches = (len(chunks) - 1) // 100 + 1
+    manager.upload_batches(scraper.iter_pinecone_batches(100), total_batches=total_batches)
     
-    return scraper, vectors
+    return scraper
 
 if __name__ == "__main__":
     main() 
@@ -0,0 +1,88 @@
+"""
+Semantic response cache for AI Advisor
+Reuses answers for repeated or near-duplicate questions, persisted in SQLite
+"""
+
+import sqlite3
+import hashlib
+import threading
+import orjson
+import numpy as np
+from typing import List, Dict, Any, Optional
+
+def _normalize(question: str) -> str:
+    return " ".join(question.lower().split())
+
+class SemanticCache:
+
+    def __init__(self, path: str = "semantic_cache.db", threshold: float = 0.93):
+        self.path = path
+        self.threshold = threshold
+        # Shared by every Streamlit session, each on its own thread
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(responses)")}
+        if columns and "scope" not in columns:
+            # Rows cached before answers were scoped cannot be tied to a prompt or index version
+            self.conn.execute("DROP TABLE responses")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses (hash TEXT PRIMARY KEY, scope TEXT, vec BLOB, answer TEXT, sources BLOB)"
+        )
+        self.conn.commit()
+
+        # Per scope: L2-normalized question vectors, row i answering values[scope][i]
+        self.keys = {}
+        self.values = {}
+        self.by_hash = {}
+        for h, scope, vec, answer, sources in self.conn.execute("SELECT hash, scope, vec, answer, sources FROM responses"):
+            self._append(h, scope, np.frombuffer(vec, dtype=np.float32), {"answer": answer, "sources": orjson.loads(sources)})
+
+    @staticmethod
+    def scope(system_prompt: str, knowledge_base_version: str) -> str:
+        """Scope for cached answers; an answer is only reused under the prompt and index version it was generated with"""
+        return hashlib.sha256(f"{system_prompt}\x00{knowledge_base_version}".encode("utf-8")).hexdigest()
+
+    def key(self, question: str, scope: str = "") -> str:
+        return hashlib.sha256(f"{scope}\x00{_normalize(question)}".encode("utf-8")).hexdigest()
+
+    def _append(self, h: str, scope: str, vector: np.ndarray, value: Dict[str, Any]):
+        # Values first, so a concurrent reader never sees a key row without its value
+        self.values.setdefault(scope, []).append(value)
+        self.by_hash[h] = value
+        row = vector[np.newaxis, :]
+        self.keys[scope] = row if scope not in self.keys else np.vstack([self.keys[scope], row])
+
+    def get_exact(self, question: str, scope: str = "") -> Optional[Dict[str, Any]]:
+        """Cached response for the same question up to case and whitespace, without embedding it"""
+        return self.by_hash.get(self.key(question, scope))
+
+    def get(self, question: str, vector: List[float], scope: str = "") -> Optional[Dict[str, Any]]:
+        """Cached response for this question or one whose embedding is within the similarity threshold"""
+        exact = self.get_exact(question, scope)
+        keys = self.keys.get(scope)
+        if exact is not None or keys is None:
+            return exact
+
+        q = np.asarray(vector, dtype=np.float32)
+        q = q / (np.linalg.norm(q) or 1.0)
+        sims = keys @ q
+        best = int(sims.argmax())
+        return self.values[scope][best] if sims[best] > self.threshold else None
+
+    def add(self, question: str, vector: List[float], answer: str, sources: List[Dict[str, Any]], scope: str = ""):
+        """Store a response; a question already cached in this scope is left untouched"""
+        h = self.key(question, scope)
+        q = np.asarray(vector, dtype=np.float32)
+        q = q / (np.linalg.norm(q) or 1.0)
+        with self.lock:
+            if h in self.by_hash:
+                return
+            self.conn.execute(
+                "INSERT OR IGNORE INTO responses (hash, scope, vec, answer, sources) VALUES (?, ?, ?, ?, ?)",
+                (h, scope, q.tobytes(), answer, orjson.dumps(sources, default=str))
+            )
+            self.conn.commit()
+            self._append(h, scope, q, {"answer": answer, "sources": sources})
+
+    def close(self):
+        self.conn.close()
@@ -1,20 +1,158 @@
 import sys
 import os
-sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+# Streamlit re-executes this script on every rerun; only add the path once
+if ROOT_DIR not in sys.path:
+    sys.path.append(ROOT_DIR)
 
 import streamlit as st
-from app.pinecone_setup import PineconeManager
-from app.retriever import RetrieverSetup
-from app.pdf_processor import PDFProcessor
-from app.batch_processor import BatchProcessor
 import io
 import contextlib
+import threading
+import time
+import tiktoken
 from datetime import datetime
 
-# Initialize components
-manager = PineconeManager()
-pdf_processor = PDFProcessor()
-batch_processor = BatchProcessor()
+# Tokens of earlier conversation sent along with each question
+CONTEXT_TOKEN_BUDGET = 1500
+_ENC = tiktoken.encoding_for_model("gpt-4o-mini")
+
+# The app modules pull in langchain, openai and pinecone; they are imported inside the
+# cached factories below so the work happens once, not as part of every rerun
+
+@st.cache_resource
+def get_manager():
+    from app.pinecone_setup import PineconeManager
+    return PineconeManager()
+
+@st.cache_resource
+def get_batch_processor():
+    from app.batch_processor import BatchProcessor
+    return BatchProcessor()
+
+# Seconds before a failed or empty knowledge base check is run again
+KB_RECHECK_SECONDS = 30
+
+class KnowledgeBaseCheck:
+    """Connects to the index and reads its stats on a background thread, so the UI never waits on Pinecone"""
+    
+    def __init__(self, manager):
+        self.manager = manager
+        self.done = False
+        self.connected = False
+        self.vector_count = None
+        self.checked_at = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self.start()
+    
+    @property
+    def ready(self) -> bool:
+        return self.connected and bool(self.vector_count)
+    
+    def start(self):
+        """Run the check unless one is already in flight"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self.done = False
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+    
+    def _run(self):
+        connected, vector_count = False, None
+        try:
+            print("Checking Pinecone knowledge base...")
+            connected = self.manager.connect_to_index()
+            if connected:
+                stats = self.manager.get_index_stats()
+                vector_count = stats.get('total_vector_count', 0) if stats else None
+        except Exception as e:
+            print(f"Error checking knowledge base: {e}")
+        finally:
+            self.connected, self.vector_count = connected, vector_count
+            self.checked_at = time.monotonic()
+            self.done = True
+    
+    def refresh(self):
+        """Check again once a failed or empty result is older than KB_RECHECK_SECONDS"""
+        if self.done and not self.ready and time.monotonic() - self.checked_at > KB_RECHECK_SECONDS:
+            self.start()
+
+@st.cache_resource
+def get_knowledge_base_check():
+    """One check per process, shared by every session and re-run while the knowledge base is not ready"""
+    # Built on the script thread; Streamlit caches are not meant to be called from our own threads
+    return KnowledgeBaseCheck(get_manager())
+
+@st.cache_resource
+def get_retriever_setup(index_name):
+    """Embeddings and Pinecone clients, built once per index rather than per session"""
+    from app.retriever import RetrieverSetup
+    return RetrieverSetup(index_name)
+
+@st.cache_resource
+def get_retriever(index_name):
+    return get_retriever_setup(index_name).setup_retriever()
+
+# Each edited system prompt builds another chain; keep only the most recent few alive
+@st.cache_resource(max_entries=8)
+def get_rag_chain(index_name, system_prompt):
+    """RAG chain, rebuilt only when the system prompt changes"""
+    return manager.create_rag_chain(get_retriever(index_name), system_prompt)
+
+@st.cache_data(ttl=60)
+def get_knowledge_base_version():
+    """Changes when the knowledge base is re-indexed, so answers cached before then are not served"""
+    stats = manager.get_index_stats()
+    vector_count = stats.get('total_vector_count') if stats else None
+    catalog_file = get_batch_processor().catalog_file
+    catalog_mtime = os.path.getmtime(catalog_file) if os.path.exists(catalog_file) else None
+    return f"{vector_count}:{catalog_mtime}"
+
+@st.cache_resource
+def get_semantic_cache():
+    """One response cache shared by every session"""
+    from app.semantic_cache import SemanticCache
+    return SemanticCache()
+
+def build_conversation_context(messages, budget=CONTEXT_TOKEN_BUDGET):
+    """Recent turns verbatim within a token budget, older ones cut to one-line summaries"""
+    lines = []
+    summarize = False
+    for msg in reversed(messages):
+        role = msg['role'].title()
+        line = f"{role}: {msg['content']}"
+        ntokens = len(_ENC.encode(line))
+        # Once a turn no longer fits, it and everything before it is summarized
+        if summarize or ntokens > budget:
+            summarize = True
+            line = f"{role}: {' '.join(msg['content'][:120].split())}..."
+            ntokens = len(_ENC.encode(line))
+            if ntokens > budget:
+                break
+        lines.append(line)
+        budget -= ntokens
+    return "\n".join(reversed(lines))
+
+def show_sources(sources):
+    with st.expander("Source Documents"):
+        for j, source in enumerate(sources):
+            st.write(f"**Source {j+1}:**")
+            content = source.get("content", "")
+            if len(content) > 500:
+                st.write(content[:500] + "...")
+            else:
+                st.write(content)
+            
+            if source.get("metadata"):
+                st.write(f"**Metadata:** {source['metadata']}")
+            st.write("---")
+
+# Initialize components once per process; reruns reuse them
+manager = get_manager()
+semantic_cache = get_semantic_cache()
+kb_check = get_knowledge_base_check()
 
 # Initialize session state for chat history
 if "messages" not in st.session_state:
@@ -25,41 +163,53 @@ if "rag_chain" not in st.session_state:
 
 if "retriever" not in st.session_state:
     st.session_state.retriever = None
+    st.session_state.retriever_setup = None
 
 # Streamlit UI
 st.title("GSU-AI-Advisor")
 st.markdown("An advisor for all things GSU")
 st.info("Information is accurate as of the 2020-21 Academic catalog")
 
-# Initialize knowledge base
-with st.spinner("Initializing knowledge base..."):
-    batch_processor.ensure_knowledge_base_ready()
+def show_knowledge_base_status():
+    """Banner for the background check; polls while the check is pending or failing"""
+    kb_check.refresh()
+    if kb_check.done and kb_check.checked_at != st.session_state.kb_checked_at:
+        # A new result is in; rerun the whole app so the retriever block below sees it
+        st.rerun()
+    
+    if not kb_check.done:
+        st.info("Checking knowledge base in the background...")
+    elif not kb_check.connected:
+        st.error("Failed to connect to Pinecone index. Please ensure the index exists and credentials are correct. Retrying shortly...")
+    elif not kb_check.ready:
+        st.warning("Knowledge base has no content yet. Run initialize_knowledge_base.py to load the catalog.")
 
-# Connect to existing index and set up retriever once
-if st.session_state.retriever is None:
-    if manager.connect_to_index():
-        st.success(f"Connected to Pinecone index: {manager.index_name}")
-        
-        # Get index statistics
-        stats = manager.get_index_stats()
-        if stats:
-            st.info(f"Index contains {stats.get('total_vector_count', 'Unknown')} vectors")
+# Knowledge base status; the chat stays usable while the background check runs.
+# The check's result drives both the banner and the retriever setup below, and the
+# banner stops polling once the knowledge base is ready
+st.session_state.kb_checked_at = kb_check.checked_at if kb_check.done else None
+st.fragment(show_knowledge_base_status, run_every=None if kb_check.ready else 2)()
+
+# Set up the retriever once the check has connected to the index
+if st.session_state.retriever is None and kb_check.done and kb_check.connected:
+    st.success(f"Connected to Pinecone index: {manager.index_name}")
+    if kb_check.vector_count is not None:
+        st.info(f"Index contains {kb_check.vector_count} vectors")
+    
+    # Set up retriever and RAG chain
+    with st.spinner("Setting up retrieval system..."):
+        f = io.StringIO()
+        with contextlib.redirect_stdout(f):
+            st.session_state.retriever = get_retriever(manager.index_name)
+            st.session_state.retriever_setup = get_retriever_setup(manager.index_name)
         
-        # Set up retriever and RAG chain
-        with st.spinner("Setting up retrieval system..."):
-            f = io.StringIO()
-            with contextlib.redirect_stdout(f):
-                retriever_setup = RetrieverSetup(manager.index_name)
-                st.session_state.retriever = retriever_setup.setup_retriever()
-            
-            if st.session_state.retriever:
-                st.success("Retrieval system ready!")
-            else:
-                st.error("Failed to set up retrieval system")
-                st.stop()
-    else:
-        st.error("Failed to connect to Pinecone index. Please ensure the index exists and credentials are correct.")
-        st.stop()
+        if st.session_state.retriever:
+            st.success("Retrieval system ready!")
+        else:
+            # Do not keep the failure cached, so the next run tries again
+            get_retriever.clear()
+            st.error("Failed to set up retrieval system")
+            st.stop()
 
 # Sidebar for configuration
 with st.sidebar:
@@ -104,19 +254,8 @@ for i, message in enumerate(st.session_state.messages):
         st.write(message["content"])
         
         # Show sources for assistant messages
-        if message["role"] == "assistant" and "sources" in message:
-            with st.expander("Source Documents"):
-                for j, source in enumerate(message["sources"]):
-                    st.write(f"**Source {j+1}:**")
-                    content = source.get("content", "")
-                    if len(content) > 500:
-                        st.write(content[:500] + "...")
-                    else:
-                        st.write(content)
-                    
-                    if source.get("metadata"):
-                        st.write(f"**Metadata:** {source['metadata']}")
-                    st.write("---")
+        if message["role"] == "assistant" and message.get("sources"):
+            show_sources(message["sources"])
 
 # Chat input
 user_input = st.chat_input("Ask a question about GSU...")
@@ -137,54 +276,58 @@ if user_input:
     with st.chat_message("assistant"):
         with st.spinner("Thinking..."):
             try:
-                # Create or update RAG chain with current system prompt
-                if st.session_state.rag_chain is None or system_prompt:
-                    st.session_state.rag_chain = manager.create_rag_chain(
-                        st.session_state.retriever, 
-                        system_prompt
-                    )
+                # Standalone questions repeat across students; follow-ups depend on their conversation.
+                # Answers are only shared under the same system prompt and knowledge base version
+                question_vector = None
+                cached = None
+                if len(st.session_state.messages) == 1 and st.session_state.retriever_setup:
+                    cache_scope = semantic_cache.scope(system_prompt, get_knowledge_base_version())
+                    question_vector = st.session_state.retriever_setup.embed_query(user_input)
+                    cached = semantic_cache.get(user_input, question_vector, cache_scope)
                 
-                if st.session_state.rag_chain:
-                    # Build context from chat history
-                    conversation_context = ""
-                    if len(st.session_state.messages) > 1:
-                        recent_messages = st.session_state.messages[-6:]  # Last 3 exchanges
-                        for msg in recent_messages[:-1]:  # Exclude current message
-                            conversation_context += f"{msg['role'].title()}: {msg['content']}\n"
-                    
-                    # Create enhanced query with conversation context
-                    enhanced_query = user_input
-                    if conversation_context:
-                        enhanced_query = f"Previous conversation:\n{conversation_context}\nCurrent question: {user_input}"
+                if cached:
+                    st.write(cached["answer"])
+                    st.caption("(cached)")
+                    if cached["sources"]:
+                        show_sources(cached["sources"])
                     
-                    # Query the RAG chain
-                    try:
-                        response = st.session_state.rag_chain.invoke({"query": enhanced_query})
-                    except Exception as e:
-                        try:
-                            response = st.session_state.rag_chain.invoke({"question": enhanced_query})
-                        except Exception as e2:
-                            response = st.session_state.rag_chain.invoke({"input": enhanced_query})
+                    st.session_state.messages.append({
+                        "role": "assistant",
+                        "content": cached["answer"],
+                        "sources": cached["sources"],
+                        "timestamp": datetime.now().isoformat()
+                    })
+                else:
+                    # Reuse the chain built for the current system prompt
+                    st.session_state.rag_chain = get_rag_chain(manager.index_name, system_prompt)
                     
-                    # Extract and display response
-                    if isinstance(response, dict):
-                        if "result" in response:
-                            answer = response["result"]
-                        elif "answer" in response:
-                            answer = response["answer"]
-                        else:
-                            answer = str(response)
+                    if st.session_state.rag_chain:
+                        # Build context from chat history, excluding the current message
+                        conversation_context = build_conversation_context(st.session_state.messages[:-1])
+                        
+                        # Create enhanced query with conversation context
+                        enhanced_query = user_input
+                        if conversation_context:
+                            enhanced_query = f"Previous conversation:\n{conversation_context}\n\nCurrent question: {user_input}"
+                        
+                        # Stream the answer as it is generated; the chain retrieves once and
+                        # emits the source documents before the first answer token
+                        retrieved = {}
                         
-                        st.write(answer)
+                        def answer_tokens():
+                            for part in st.session_state.rag_chain.stream({"question": enhanced_query}):
+                                if "source_documents" in part:
+                                    retrieved["documents"] = part["source_documents"]
+                                if "answer" in part:
+                                    yield part["answer"]
+                        
+                        answer = st.write_stream(answer_tokens())
                         
                         # Prepare sources for storage
-                        sources = []
-                        if "source_documents" in response and response["source_documents"]:
-                            for doc in response["source_documents"]:
-                                sources.append({
-                                    "content": doc.page_content,
-                                    "metadata": getattr(doc, 'metadata', {})
-                                })
+                        sources = [
+                            {"content": doc.page_content, "metadata": doc.metadata}
+                            for doc in retrieved.get("documents", [])
+                        ]
                         
                         # Add assistant message to chat history
                         st.session_state.messages.append({
@@ -194,33 +337,17 @@ if user_input:
                             "timestamp": datetime.now().isoformat()
                         })
                         
+                        # Remember standalone answers for the next student who asks
+                        if question_vector is not None:
+                            semantic_cache.add(user_input, question_vector, answer, sources, cache_scope)
+                        
                         # Show sources in expandable section
                         if sources:
-                            with st.expander("Source Documents"):
-                                for i, source in enumerate(sources):
-                                    st.write(f"**Source {i+1}:**")
-                                    content = source.get("content", "")
-                                    if len(content) > 500:
-                                        st.write(content[:500] + "...")
-                                    else:
-                                        st.write(content)
-                                    
-                                    if source.get("metadata"):
-                                        st.write(f"**Metadata:** {source['metadata']}")
-                                    st.write("---")
-                    else:
-                        answer = str(response)
-                        st.write(answer)
+                            show_sources(sources)
                         
-                        # Add simple response to history
-                        st.session_state.messages.append({
-                            "role": "assistant",
-                            "content": answer,
-                            "timestamp": datetime.now().isoformat()
-                        })
-                        
-                else:
-                    st.error("Failed to create RAG chain.")
+                    else:
+                        get_rag_chain.clear()
+                        st.error("Failed to create RAG chain.")
                     
             except Exception as e:
                 st.error(f"An error occurred: {str(e)}")
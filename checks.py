@@ -0,0 +1,88 @@
+"""
+Installation checks for AI Advisor
+Each check_<package> is built on first access, so nothing heavy is imported until a check runs
+"""
+
+import os
+import re
+import functools
+import importlib
+import importlib.util
+from typing import Tuple, Optional
+
+# (display name, import name, attribute to resolve or None); an immutable constant
+# built once at import, not per call
+_PACKAGES: Tuple[Tuple[str, str, Optional[str]], ...] = (
+    ("streamlit", "streamlit", None),
+    ("langchain", "langchain", None),
+    ("langchain.text_splitter", "langchain.text_splitter", "RecursiveCharacterTextSplitter"),
+    ("openai", "openai", None),
+    ("beautifulsoup4 (bs4)", "bs4", None),
+    ("requests", "requests", None),
+    ("python-dotenv (dotenv)", "dotenv", None),
+    ("pinecone", "pinecone", None),
+)
+
+def name_for_package(import_name):
+    """Check name for an import name, e.g. langchain.text_splitter -> check_langchain_text_splitter"""
+    return "check_" + re.sub(r"\W", "_", import_name)
+
+_CHECKS = {name_for_package(import_name): (display_name, import_name, attr) for display_name, import_name, attr in _PACKAGES}
+
+__all__ = tuple(_CHECKS)
+
+def probe(import_name, attr=None, mode="spec") -> Tuple[bool, Optional[str]]:
+    """Whether a module (and attribute) is available, with the reason when it is not; memoized"""
+    # lru_cache keys on call shape, so pass one positional form; attribute checks always import
+    return _probe(import_name, attr or None, "import" if attr else mode)
+
+@functools.lru_cache(maxsize=None)
+def _probe(import_name, attr, mode) -> Tuple[bool, Optional[str]]:
+    try:
+        # "spec" only locates the module without running it
+        if mode == "spec":
+            if importlib.util.find_spec(import_name) is None:
+                raise ModuleNotFoundError(f"No module named '{import_name}'")
+            return True, None
+
+        module = importlib.import_module(import_name)
+        if attr:
+            getattr(module, attr)
+        return True, None
+    except ModuleNotFoundError as e:
+        return False, f"Not installed - {e}"
+    except ImportError as e:
+        return False, f"Import failed - {e}"
+    except AttributeError as e:
+        return False, f"Imported but {attr} is missing - {e}"
+
+def test_package(package_name, import_name=None, attr=None, mode="spec"):
+    """Test if a package can be imported, returning (success, result line)"""
+    success, error = probe(import_name or package_name, attr, mode)
+    if not success:
+        return False, f"❌ {package_name}: {error}"
+    if mode == "spec" and not attr:
+        return True, f"✅ {package_name}: Found"
+    return True, f"✅ {package_name}: Successfully imported"
+
+def __getattr__(name):
+    """Build check_<package> on first access (PEP 562) and keep it for later lookups"""
+    if name not in _CHECKS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    display_name, import_name, attr = _CHECKS[name]
+
+    def check(mode="spec"):
+        return test_package(display_name, import_name, attr, mode=mode)
+
+    check.__name__ = name
+    globals()[name] = check
+    return check
+
+# CI can run every check up front, importing each package, so a broken install shows at import time;
+# results are memoized, so the checks run afterwards reuse them
+if os.getenv("GSU_EAGER_CHECKS") == "1":
+    for _name in __all__:
+        _success, _line = __getattr__(_name)(mode="import")
+        if not _success:
+            print(_line)